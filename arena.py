@@ -0,0 +1,295 @@
+'''
+Tournaments between models and baseline players, with Elo ratings.
+
+Players (comma separated in `players`):
+- random: uniformly random legal moves
+- tactical: wins immediately if it can, else blocks, else a random move that does not give
+  the opponent an immediate win (c4solver.non_losing_moves)
+- solver: perfect play (c4solver.Solver, random among the best moves), slow in the opening
+- <out_dir>: a model, playing its most likely legal move
+- mcts:<out_dir>: a model searching with mcts.MCTS (mcts_simulations per move)
+
+Matches are scheduled round-robin (every pair) or as a gauntlet (the first player against
+all others). Every match consists of games_per_pair game pairs: both games of a pair start
+with the same random opening (opening_plies moves), with the colours swapped. Game pairs
+are played in a process pool, every worker keeps one copy of each player it has used.
+
+Every finished game is appended to results_path as a JSON line, games already in the file
+are not played again, so an interrupted tournament is resumed by running the same command.
+Elo ratings are fitted to all games in the file (Bradley-Terry, draws count as half a win)
+with bootstrap confidence intervals, anchored at random = 0 if it takes part.
+
+Example usage:
+$ python arena.py --players=random,tactical,out-connect-four-simple,out-connect-four-full --num_workers=8
+'''
+import json
+import os
+import time
+from itertools import combinations
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+
+from c4engine import C4Engine
+from c4solver import Solver, non_losing_moves, possible_moves, winning_spots, COLUMN_MASKS, WIDTH
+
+class RandomPlayer:
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def move(self, engine: C4Engine, moves: str) -> str:
+        legal = [x for x in range(WIDTH) if engine.is_legal_move(str(x))]
+        return str(self.rng.choice(legal))
+
+
+class TacticalPlayer(RandomPlayer):
+
+    def move(self, engine: C4Engine, moves: str) -> str:
+        position, mask, _ = Solver._position(engine)
+        possible = possible_moves(mask)
+        candidates = (possible & winning_spots(position, mask)) or non_losing_moves(position, mask) or possible
+        columns = [x for x in range(WIDTH) if candidates & COLUMN_MASKS[x]]
+        return str(self.rng.choice(columns))
+
+
+class SolverPlayer(RandomPlayer):
+
+    def __init__(self, rng):
+        super().__init__(rng)
+        self.solver = Solver()
+
+    def move(self, engine: C4Engine, moves: str) -> str:
+        return str(self.rng.choice(self.solver.best_moves(engine)))
+
+
+class ModelPlayer:
+
+    def __init__(self, out_dir: str, device: str = 'cpu', mcts_simulations: int = 0):
+        from checkpoint import load_model
+        from logits_cache import CachedGPT
+        from tokenizer import Tokenizer
+        self.device = device
+        self.model, self.meta, _ = load_model(out_dir, device)
+        self.cached_model = CachedGPT(self.model) # deterministic play, openings repeat a lot
+        self.mcts = None
+        if mcts_simulations > 0:
+            from mcts import MCTS
+            self.mcts = MCTS(self.model, self.meta, device=device)
+        self.mcts_simulations = mcts_simulations
+        self.tokenizer = Tokenizer(self.meta)
+
+    def tokens(self, moves: str) -> list[int]:
+        ''' token ids of a game given in the simple encoding (e.g. S0123) '''
+        return self.tokenizer.encode_moves(moves)
+
+    @torch.no_grad()
+    def move(self, engine: C4Engine, moves: str) -> str:
+        if self.mcts is not None:
+            return self.mcts.search(engine, self.tokens(moves), self.mcts_simulations)
+        x = torch.tensor(self.tokens(moves), dtype=torch.long, device=self.device)[None, ...]
+        legal = torch.tensor(engine.legal_token_mask(self.meta), device=self.device)[None, ...]
+        logits = self.cached_model.next_logits(x).float().masked_fill(~legal, -float('Inf'))
+        return str(self.tokenizer.token_cols[logits.argmax(dim=-1).item()])
+
+
+def make_player(name: str, rng, device: str = 'cpu', mcts_simulations: int = 200):
+    if name == 'random':
+        return RandomPlayer(rng)
+    if name == 'tactical':
+        return TacticalPlayer(rng)
+    if name == 'solver':
+        return SolverPlayer(rng)
+    if name.startswith('mcts:'):
+        return ModelPlayer(name[len('mcts:'):], device, mcts_simulations)
+    return ModelPlayer(name, device)
+
+
+def play_game(player_a, player_b, opening: str) -> tuple[str, str]:
+    ''' (moves, result) of a game starting with the opening (e.g. S34), A moves first '''
+    engine = C4Engine(opening)
+    moves = opening
+    while engine.result() is None:
+        player = player_a if engine.player_to_move() == 'A' else player_b
+        move = player.move(engine, moves)
+        if not engine.make_move(move):
+            raise RuntimeError(f'illegal move {move} after {moves}')
+        moves += move
+    return moves, engine.result()
+
+
+_worker_players = None
+_worker_config = None
+
+def _init_worker(config: dict) -> None:
+    global _worker_players, _worker_config
+    _worker_players = {} # one copy of every player per worker process
+    _worker_config = config
+    torch.set_num_threads(1)
+
+
+def _play_pair(task: tuple[str, str, int, str, tuple[int, ...]]) -> list[dict]:
+    name_a, name_b, pair, opening, games = task
+    records = []
+    for game in games:
+        first, second = (name_a, name_b) if game == 0 else (name_b, name_a)
+        players = []
+        for name in (first, second):
+            if name not in _worker_players:
+                rng = np.random.default_rng([_worker_config['seed'], os.getpid()])
+                _worker_players[name] = make_player(name, rng, _worker_config['device'], _worker_config['mcts_simulations'])
+            players.append(_worker_players[name])
+        moves, result = play_game(*players, opening)
+        records.append({'match': [name_a, name_b], 'pair': pair, 'game': game, 'A': first, 'B': second,
+                        'opening': opening, 'moves': moves, 'result': result})
+    return records
+
+
+def random_opening(rng, plies: int) -> str:
+    ''' random legal moves that do not finish the game '''
+    while True:
+        player = RandomPlayer(rng)
+        engine = C4Engine(C4Engine.START)
+        moves = C4Engine.START
+        for _ in range(plies):
+            if engine.result() is not None:
+                break
+            moves += player.move(engine, moves)
+            engine.make_move(moves[-1])
+        if engine.result() is None:
+            return moves
+
+
+def schedule(names: list[str], mode: str, games_per_pair: int, opening_plies: int, seed: int) -> list[tuple[str, str, int, str, tuple[int, ...]]]:
+    ''' game pair tasks (name_a, name_b, pair index, opening, games), game 0 - name_a plays A, game 1 - name_b plays A '''
+    if mode == 'round_robin':
+        matches = list(combinations(names, 2))
+    elif mode == 'gauntlet':
+        matches = [(names[0], name) for name in names[1:]]
+    else:
+        raise ValueError(f'unknown schedule {mode}')
+    rng = np.random.default_rng(seed)
+    openings = [random_opening(rng, opening_plies) for _ in range(games_per_pair)]
+    return [(a, b, i, openings[i], (0, 1)) for a, b in matches for i in range(games_per_pair)]
+
+
+def read_results(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def fit_elo(records: list[dict], names: list[str], prior: float = 1.0, iters: int = 10000, tol: float = 1e-10) -> np.ndarray:
+    '''
+    Maximum likelihood Bradley-Terry ratings on the Elo scale (minorization-maximization),
+    draws count as half a win for both players. Every pair of players that met gets `prior`
+    virtual draws, so ratings stay finite for players that never won or never lost.
+    Players without games are unrated (NaN) and left out of the fit.
+    '''
+    idx = {name: i for i, name in enumerate(names)}
+    n = len(names)
+    points = np.zeros((n, n)) # points of i against j
+    for r in records:
+        a, b = idx[r['A']], idx[r['B']]
+        s = {'A': 1.0, 'B': 0.0, 'D': 0.5}[r['result']]
+        points[a, b] += s
+        points[b, a] += 1 - s
+    rated = (points + points.T).sum(axis=1) > 0
+    elo = np.full(n, np.nan)
+    if not rated.any():
+        return elo
+    points = points[rated][:, rated]
+    n = len(points)
+    games = points + points.T
+    met = games > 0
+    points += prior * 0.5 * met
+    games += prior * met
+    gamma = np.ones(n)
+    for _ in range(iters):
+        new = points.sum(axis=1) / (games / (gamma[:, None] + gamma[None, :])).sum(axis=1)
+        new /= np.exp(np.log(new).mean())
+        if np.abs(new - gamma).max() < tol:
+            gamma = new
+            break
+        gamma = new
+    elo[rated] = 400 * np.log10(gamma)
+    return elo
+
+
+def bootstrap_elo(records: list[dict], names: list[str], num_samples: int = 200, seed: int = 0,
+                  anchor: str | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    ''' ratings, 2.5% and 97.5% quantiles over num_samples resamplings of the games (NaN for unrated players) '''
+    def fit(sample):
+        elo = fit_elo(sample, names)
+        if anchor in names and not np.isnan(elo[names.index(anchor)]):
+            return elo - elo[names.index(anchor)]
+        return elo - np.nanmean(elo) if not np.isnan(elo).all() else elo
+    rng = np.random.default_rng(seed)
+    elo = fit(records)
+    low, high = np.full(len(names), np.nan), np.full(len(names), np.nan)
+    rated = ~np.isnan(elo)
+    if rated.any():
+        samples = np.stack([fit([records[i] for i in rng.integers(len(records), size=len(records))]) for _ in range(num_samples)])
+        # a player can miss from a resampling, its quantiles are over the samples it is in
+        low[rated] = np.nanpercentile(samples[:, rated], 2.5, axis=0)
+        high[rated] = np.nanpercentile(samples[:, rated], 97.5, axis=0)
+    return elo, low, high
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    players = 'random,tactical,out-connect-four-simple' # comma separated, see above
+    mode = 'round_robin' # 'round_robin' or 'gauntlet' (first player against all others)
+    games_per_pair = 50 # game pairs (both colours) per match
+    opening_plies = 2 # random moves at the start of every game pair
+    results_path = 'arena.jsonl'
+    num_workers = os.cpu_count()
+    device = 'cpu' # model players, e.g. 'cuda' with num_workers=1
+    mcts_simulations = 200 # mcts:<out_dir> players
+    num_bootstrap = 200
+    seed = 1337
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    names = players.split(',')
+    tasks = schedule(names, mode, games_per_pair, opening_plies, seed)
+    done = {}
+    for r in read_results(results_path):
+        done.setdefault((*r['match'], r['pair']), set()).add(r['game'])
+    tasks = [(*t[:4], tuple(g for g in t[4] if g not in done.get(t[:3], ()))) for t in tasks]
+    tasks = [t for t in tasks if t[4]]
+    print(f"{len(tasks):,} game pairs to play ({sum(len(g) == 2 for g in done.values()):,} already in {results_path})")
+
+    t0 = time.time()
+    config = dict(seed=seed, device=device, mcts_simulations=mcts_simulations)
+    with open(results_path, 'a') as f:
+        def write(records):
+            for r in records:
+                f.write(json.dumps(r) + '\n')
+            f.flush()
+        if num_workers > 1:
+            with Pool(num_workers, initializer=_init_worker, initargs=(config,)) as pool:
+                for i, records in enumerate(pool.imap_unordered(_play_pair, tasks)):
+                    write(records)
+                    if (i + 1) % 100 == 0:
+                        print(f"{i + 1:,}/{len(tasks):,} game pairs, {time.time() - t0:.1f}s")
+        else:
+            _init_worker(config)
+            for records in map(_play_pair, tasks):
+                write(records)
+    print(f"played {sum(len(t[4]) for t in tasks):,} games in {time.time() - t0:.2f}s")
+
+    # ratings of the players of this tournament, from all of their games in the file
+    records = [r for r in read_results(results_path) if r['A'] in names and r['B'] in names]
+    elo, low, high = bootstrap_elo(records, names, num_bootstrap, seed, anchor='random')
+    print(f"{'player':<40} {'games':>6} {'score':>7} {'elo':>7}   95% interval")
+    for i in sorted(range(len(names)), key=lambda i: -elo[i] if not np.isnan(elo[i]) else np.inf):
+        name = names[i]
+        games = [r for r in records if name in (r['A'], r['B'])]
+        score = sum(1.0 if r['result'] == ('A' if r['A'] == name else 'B') else 0.5 if r['result'] == 'D' else 0.0 for r in games)
+        if np.isnan(elo[i]):
+            print(f"{name:<40} {len(games):>6} {'':>7} {'unrated':>7}")
+            continue
+        print(f"{name:<40} {len(games):>6} {100 * score / max(len(games), 1):>6.1f}% {elo[i]:>7.0f}   [{low[i]:.0f}, {high[i]:.0f}]")
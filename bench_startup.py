@@ -0,0 +1,66 @@
+"""
+Startup latency of the command-line entry points.
+
+Every check runs in a fresh interpreter (so nothing is cached in sys.modules) and is repeated
+num_runs times, the median wall time is reported:
+- python: bare interpreter start, the floor for everything else
+- torch, numpy: the unavoidable imports
+- tiktoken, transformers, wandb: optional dependencies, only imported by sample.py (GPT-2
+  encodings), GPT.from_pretrained and train.py (wandb_log=True); skipped if not installed
+- imports: the modules imported by play.py/evaluate.py
+- model ready: imports + checkpoint.load_model
+- first move: model ready + prediction of the first move of a game
+With out_file the results are appended as one JSON line, to track them over time.
+
+Example usage:
+$ python bench_startup.py --out_dir=out-connect-four-simple --device=cpu
+"""
+import importlib.util
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# -----------------------------------------------------------------------------
+out_dir = 'out-connect-four-simple' # model for the 'model ready' and 'first move' checks, '' to skip them
+device = 'cpu'
+num_runs = 5
+out_file = '' # e.g. 'startup.jsonl'
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+IMPORTS = 'import torch, numpy, c4engine, checkpoint, logits_cache, cpu_inference, evaluate'
+LOAD = f'{IMPORTS}; model, meta, _ = checkpoint.load_model({out_dir!r}, {device!r})'
+FIRST_MOVE = (f'{LOAD}; x = torch.tensor([[meta["stoi"][meta["start_token"]]]], device={device!r}); '
+              'torch.no_grad()(model)(x)[0].argmax().item()')
+
+checks = {
+    'python': 'pass',
+    'torch': 'import torch',
+    'numpy': 'import numpy',
+}
+for module in ('tiktoken', 'transformers', 'wandb'):
+    if importlib.util.find_spec(module) is not None:
+        checks[module] = f'import {module}'
+checks['imports'] = IMPORTS
+if out_dir:
+    checks['model ready'] = LOAD
+    checks['first move'] = FIRST_MOVE
+
+
+def run(code: str) -> float:
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - t0
+
+
+results = {}
+for name, code in checks.items():
+    run(code) # warm the OS file cache
+    results[name] = statistics.median(run(code) for _ in range(num_runs))
+    print(f"{name:>14}: {1000*results[name]:8.1f}ms")
+
+if out_file:
+    with open(out_file, 'a') as f:
+        f.write(json.dumps({'time': time.time(), 'out_dir': out_dir, 'device': device, 'seconds': results}) + '\n')
@@ -0,0 +1,164 @@
+'''
+Opening book of solved Connect-Four positions.
+
+The book is a flat binary file: a header (magic, number of entries, max ply), then the
+sorted keys (uint64) followed by the exact solver scores (int8). A position and its mirror
+image have the same score and share one entry, keyed by the smaller of their C4Engine
+Zobrist hashes. OpeningBook memory-maps it and finds positions with a binary search, so
+nothing is loaded into RAM and many processes on one host share the same pages via the
+page cache.
+
+Building the book solves only the positions with max_ply pieces following the start
+opening, with a pool of workers; the shallower positions get the negamax of the scores of
+their children. Positions with few pieces are expensive for the pure Python solver (an
+8-ply position takes from 17 s to 4 min), so a book from the empty board is out of reach:
+the book covers only the one fixed opening line given by start, and arena.py does not use it.
+The default, the book of S3333334 up to ply 9 (34 positions solved), took 15 min on one core.
+Example usage:
+$ python c4book.py --start=S3333334 --max_ply=9 --book_path=book.bin --num_workers=16
+'''
+import os
+import time
+from multiprocessing import Pool
+from typing import Dict, List
+
+import numpy as np
+
+from c4engine import C4Engine
+from c4solver import Solver
+
+MAGIC = int.from_bytes(b'C4BOOK02', 'little') # 02: one entry per mirror pair
+HEADER_SIZE = 3 * 8
+
+
+class OpeningBook:
+
+    def __init__(self, path: str):
+        header = np.fromfile(path, dtype=np.uint64, count=3)
+        if len(header) != 3 or header[0] != MAGIC:
+            raise ValueError(f'{path} is not an opening book file')
+        self.num_entries = int(header[1])
+        self.max_ply = int(header[2])
+        if self.num_entries:
+            self._keys = np.memmap(path, dtype=np.uint64, mode='r', offset=HEADER_SIZE, shape=(self.num_entries,))
+            self._scores = np.memmap(path, dtype=np.int8, mode='r', offset=HEADER_SIZE + 8 * self.num_entries, shape=(self.num_entries,))
+        else:
+            self._keys = np.zeros(0, dtype=np.uint64)
+            self._scores = np.zeros(0, dtype=np.int8)
+
+
+    def __len__(self) -> int:
+        return self.num_entries
+
+
+    def get(self, key: int) -> int | None:
+        ''' Score stored for a key (book_key), None if missing '''
+        key = np.uint64(key)
+        i = int(np.searchsorted(self._keys, key))
+        if i < self.num_entries and self._keys[i] == key:
+            return int(self._scores[i])
+        return None
+
+
+    def lookup(self, engine: C4Engine) -> int | None:
+        ''' Score of the engine's position for the player to move, None if not in the book '''
+        if engine.result() is not None or engine._num_moves > self.max_ply:
+            return None
+        return self.get(book_key(engine))
+
+
+def write_book(path: str, keys: np.ndarray, scores: np.ndarray, max_ply: int) -> None:
+    order = np.argsort(keys)
+    with open(path, 'wb') as f:
+        np.array([MAGIC, len(keys), max_ply], dtype=np.uint64).tofile(f)
+        keys.astype(np.uint64)[order].tofile(f)
+        scores.astype(np.int8)[order].tofile(f)
+
+
+def book_key(engine: C4Engine) -> int:
+    ''' Key of a position in the book, shared with its mirror image (same score) '''
+    return min(engine.hash(), engine.mirror_hash())
+
+
+def enumerate_positions(max_ply: int, start: str = C4Engine.START) -> List[Dict[int, str]]:
+    '''
+    Move sequences reaching every distinct unfinished position (one of every mirror pair) by ply,
+    from the ply of start up to max_ply, keyed by book_key
+    '''
+    frontier = {book_key(C4Engine(start)): start}
+    plies = [frontier]
+    for _ in range(C4Engine(start)._num_moves, max_ply):
+        next_frontier = {}
+        for moves in frontier.values():
+            engine = C4Engine(moves)
+            for x in range(C4Engine.WIDTH):
+                if engine.make_move(str(x)):
+                    key = book_key(engine)
+                    if engine.result() is None and key not in next_frontier:
+                        next_frontier[key] = moves + str(x)
+                    engine.unmake_move()
+        frontier = next_frontier
+        plies.append(frontier)
+    return plies
+
+
+def backup_score(moves: str, scores: Dict[int, int]) -> int:
+    ''' Negamax score of a position from the scores of its children (immediate wins and draws checked directly) '''
+    engine = C4Engine(moves)
+    n = engine._num_moves
+    best = None
+    for x in range(C4Engine.WIDTH):
+        if engine.make_move(str(x)):
+            if engine.result() == C4Engine.DRAW:
+                score = 0
+            elif engine.result() is not None:
+                score = (C4Engine.WIDTH * C4Engine.HEIGHT + 1 - n) // 2 # win with this move
+            else:
+                score = -scores[book_key(engine)]
+            engine.unmake_move()
+            best = score if best is None else max(best, score)
+    return best
+
+
+_worker_solver = None
+
+def _solve_position(moves: str) -> int:
+    global _worker_solver
+    if _worker_solver is None:
+        _worker_solver = Solver() # one solver (and transposition table) per worker process
+    return _worker_solver.solve(C4Engine(moves))
+
+
+def build_book(path: str, max_ply: int, num_workers: int = 1, start: str = C4Engine.START) -> None:
+    plies = enumerate_positions(max_ply, start)
+    frontier = plies[-1]
+    print(f"solving {len(frontier):,} positions of ply {max_ply} with {num_workers} workers "
+          f"({sum(len(p) for p in plies):,} positions up to ply {max_ply}, one of every mirror pair)")
+    t0 = time.time()
+    # only the deepest positions are searched, siblings next to each other share the transposition tables
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            results = pool.map(_solve_position, frontier.values(), chunksize=16)
+    else:
+        results = [_solve_position(p) for p in frontier.values()]
+    scores = dict(zip(frontier.keys(), results))
+    print(f"solved ply {max_ply} in {time.time() - t0:.2f}s")
+    # shallower plies by negamax over the scores of their children
+    for positions in reversed(plies[:-1]):
+        for key, moves in positions.items():
+            scores[key] = backup_score(moves, scores)
+    keys = np.array(list(scores.keys()), dtype=np.uint64)
+    values = np.array(list(scores.values()), dtype=np.int8)
+    write_book(path, keys, values, max_ply)
+    print(f"wrote {len(keys):,} positions to {path} in {time.time() - t0:.2f}s")
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    max_ply = 9 # solve every position with at most this many pieces
+    start = 'S3333334' # the book covers the positions following this opening
+    book_path = 'book.bin'
+    num_workers = os.cpu_count()
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+    build_book(book_path, max_ply, num_workers, start)
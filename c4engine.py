@@ -1,7 +1,60 @@
+import random
 from typing import List
 
+import numpy as np
+
+
+def _zobrist_keys(num_players: int, num_bits: int, seed: int = 0xC4) -> List[List[int]]:
+    # fixed seed, so hashes are stable between runs and processes
+    rng = random.Random(seed)
+    return [[rng.getrandbits(64) for bit in range(num_bits)] for player in range(num_players)]
+
+
+def legal_token_mask(meta: dict, heights: np.ndarray, turns: np.ndarray, results: np.ndarray) -> np.ndarray:
+    '''
+    (N, vocab_size) mask of the tokens of a dataset vocabulary (meta.pkl) that are legal next tokens
+    for N started games given as column heights (N, WIDTH), players to move (N,) and result codes
+    (N,) of BatchC4Engine. Works for all tokenizations: move tokens start with the column and may
+    be followed by the row (counted from the top) and/or the player ('a' or 'b'), e.g. 3, 3a, 32a.
+    '''
+    vocab_size = meta['vocab_size']
+    col = np.full(vocab_size, -1)
+    row = np.full(vocab_size, -1)
+    player = np.full(vocab_size, -1)
+    result = np.full(vocab_size, -1)
+    for i, token in meta['itos'].items():
+        move = meta['stom'][token]
+        if move in C4Engine.RESULT_TYPES:
+            result[i] = BatchC4Engine.RESULT_CODES.index(move)
+        elif move != C4Engine.START:
+            col[i] = int(move)
+            if len(token) > 1:
+                player[i] = C4Engine.PLAYERS.lower().index(token[-1])
+            if len(token) > 2:
+                row[i] = int(token[1])
+
+    is_move = col >= 0
+    safe_col = np.where(is_move, col, 0)
+    h = heights[:, safe_col] # (N, vocab_size)
+    move_ok = is_move & (h < C4Engine.HEIGHT) & (results == BatchC4Engine.NO_RESULT)[:, None]
+    move_ok &= (player < 0) | (player == turns[:, None])
+    move_ok &= (row < 0) | (row == C4Engine.HEIGHT - 1 - h)
+    result_ok = (result >= 0) & (result == results[:, None])
+    return move_ok | result_ok
+
 
 class C4Engine:
+    '''
+    Connect-Four engine backed by bitboards.
+
+    Each player owns a (HEIGHT+1)*WIDTH bit integer. Bit `x*(HEIGHT+1) + y` is set when
+    the player has a piece in column x, row y (counted from the bottom). The extra bit
+    on top of every column is always empty, so shifted masks never wrap between columns.
+    The string board returned by `board()` is only built on demand.
+
+    Moves can be taken back with `unmake_move` and every position carries an incrementally
+    updated 64-bit Zobrist hash (`hash()`), `mirror_hash()` is the hash of its mirror image.
+    '''
     WIDTH = 7
     HEIGHT = 6
     START = 'S'
@@ -11,6 +64,11 @@ class C4Engine:
     RESULT_TYPES = PLAYERS + DRAW
     MOVES = list(START + RESULT_TYPES) + [str(i) for i in range(WIDTH)]
 
+    # bit shifts for the four directions: vertical, horizontal, diagonal (/), diagonal (\)
+    _DIRECTIONS = (1, HEIGHT + 1, HEIGHT + 2, HEIGHT)
+    # random keys for every (player, bit) pair
+    _ZOBRIST = _zobrist_keys(len(PLAYERS), WIDTH * (HEIGHT + 1))
+
     def __init__(self, start_seq: str = ''):
         self.reset()
         for move in start_seq:
@@ -18,13 +76,41 @@ class C4Engine:
 
 
     def reset(self) -> None:
-        self._board = [[C4Engine.EMPTY for x in range(C4Engine.WIDTH)] for y in range(C4Engine.HEIGHT)]
+        self._bitboards = [0, 0]
+        self._heights = [0] * C4Engine.WIDTH
+        self._num_moves = 0
+        self._history = []
+        self._hash = 0
+        self._board = None
+        self._last_y = None
         self._game_started = False
         self._result = None
         self._turn = 0
 
 
+    def copy(self) -> 'C4Engine':
+        engine = object.__new__(C4Engine)
+        engine._bitboards = self._bitboards[:]
+        engine._heights = self._heights[:]
+        engine._num_moves = self._num_moves
+        engine._history = self._history[:]
+        engine._hash = self._hash
+        engine._board = None
+        engine._last_y = self._last_y
+        engine._game_started = self._game_started
+        engine._result = self._result
+        engine._turn = self._turn
+        return engine
+
+
     def board(self) -> List[List[str]]:
+        if self._board is None:
+            self._board = [[C4Engine.EMPTY for x in range(C4Engine.WIDTH)] for y in range(C4Engine.HEIGHT)]
+            for player, bitboard in zip(C4Engine.PLAYERS, self._bitboards):
+                for x in range(C4Engine.WIDTH):
+                    for y in range(self._heights[x]):
+                        if bitboard >> (x * (C4Engine.HEIGHT + 1) + y) & 1:
+                            self._board[C4Engine.HEIGHT - 1 - y][x] = player
         return self._board
 
 
@@ -36,6 +122,32 @@ class C4Engine:
         return C4Engine.PLAYERS[self._turn]
 
 
+    def hash(self) -> int:
+        return self._hash
+
+
+    def mirror_hash(self) -> int:
+        ''' Zobrist hash of the position mirrored left/right (column x -> WIDTH-1-x) '''
+        h = 0
+        for turn, bitboard in enumerate(self._bitboards):
+            for x in range(C4Engine.WIDTH):
+                column = (bitboard >> (x * (C4Engine.HEIGHT + 1))) & ((1 << C4Engine.HEIGHT) - 1)
+                base = (C4Engine.WIDTH - 1 - x) * (C4Engine.HEIGHT + 1)
+                while column:
+                    y = (column & -column).bit_length() - 1
+                    h ^= C4Engine._ZOBRIST[turn][base + y]
+                    column &= column - 1
+        return h
+
+
+    def legal_token_mask(self, meta: dict) -> np.ndarray:
+        ''' (vocab_size,) mask of legal next tokens in the vocabulary from meta.pkl, see legal_token_mask '''
+        if not self._game_started:
+            return np.array([meta['stom'][meta['itos'][i]] == C4Engine.START for i in range(meta['vocab_size'])])
+        result = BatchC4Engine.RESULT_CODES.index(self._result)
+        return legal_token_mask(meta, np.array([self._heights]), np.array([self._turn]), np.array([result]))[0]
+
+
     def is_legal_move(self, move: str) -> bool:
         if move not in C4Engine.MOVES:
             return False
@@ -52,7 +164,7 @@ class C4Engine:
         if self._result is not None:
             return False
 
-        return self._board[0][int(move)] == C4Engine.EMPTY
+        return self._heights[int(move)] < C4Engine.HEIGHT
 
 
     def make_move(self, move: str) -> bool:
@@ -67,37 +179,159 @@ class C4Engine:
             return True
 
         x = int(move)
-        for y, row in enumerate(self._board[::-1], 1):
-            if row[x] == C4Engine.EMPTY:
-                row[x] = C4Engine.PLAYERS[self._turn]
-                break
-        self._last_y = C4Engine.HEIGHT - y
-        self._result = self._get_result(x, self._last_y)
+        y = self._heights[x]
+        bit = x * (C4Engine.HEIGHT + 1) + y
+        self._bitboards[self._turn] |= 1 << bit
+        self._hash ^= C4Engine._ZOBRIST[self._turn][bit]
+        self._heights[x] = y + 1
+        self._num_moves += 1
+        self._history.append((x, self._turn))
+        self._board = None
+        self._last_y = C4Engine.HEIGHT - 1 - y
+        self._result = self._get_result()
         self._turn = 1 - self._turn
 
         return True
 
 
-    def _get_result(self, move_x: int, move_y: int) -> str | None:
-        player = self._board[move_y][move_x]
-        dirs = [(0,1), (1,0), (1,1), (1,-1)]
+    def unmake_move(self) -> bool:
+        '''
+        Take back the last piece move (START and result tokens are not recorded).
+        Returns False if there is nothing to take back.
+        '''
+        if not self._history:
+            return False
+
+        x, turn = self._history.pop()
+        y = self._heights[x] - 1
+        bit = x * (C4Engine.HEIGHT + 1) + y
+        self._bitboards[turn] &= ~(1 << bit)
+        self._hash ^= C4Engine._ZOBRIST[turn][bit]
+        self._heights[x] = y
+        self._num_moves -= 1
+        self._board = None
+        self._last_y = C4Engine.HEIGHT - self._heights[self._history[-1][0]] if self._history else None
+        self._result = None
+        self._turn = turn
+
+        return True
+
+
+    def _get_result(self) -> str | None:
+        bitboard = self._bitboards[self._turn]
+        for shift in C4Engine._DIRECTIONS:
+            pairs = bitboard & (bitboard >> shift)
+            if pairs & (pairs >> (2 * shift)):
+                return C4Engine.PLAYERS[self._turn]
+
+        return C4Engine.DRAW if self._num_moves == C4Engine.WIDTH * C4Engine.HEIGHT else None
+
+
+class BatchC4Engine:
+    '''
+    Vectorized engine playing N games at once.
+
+    Uses the same bitboard layout as C4Engine, stored as an (N, 2) uint64 array. Moves are
+    given as column indices, games always start in the started state (no START token) and
+    a negative column means "no move" for that game.
+    Result codes: NO_RESULT, RESULT_A, RESULT_B, RESULT_DRAW (index into RESULT_CODES).
+    '''
+    NO_RESULT = 0
+    RESULT_A = 1
+    RESULT_B = 2
+    RESULT_DRAW = 3
+    RESULT_CODES = [None] + list(C4Engine.RESULT_TYPES)
+
+    _COLUMN_BITS = C4Engine.HEIGHT + 1
+
+    def __init__(self, n: int):
+        self.n = n
+        self.reset()
+
+
+    def reset(self) -> None:
+        self._bitboards = np.zeros((self.n, 2), dtype=np.uint64)
+        self._heights = np.zeros((self.n, C4Engine.WIDTH), dtype=np.int8)
+        self._num_moves = np.zeros(self.n, dtype=np.int8)
+        self._results = np.zeros(self.n, dtype=np.int8)
+        self._last_y = np.full(self.n, -1, dtype=np.int8)
+
+
+    def heights(self) -> np.ndarray:
+        ''' (N, WIDTH) number of pieces in each column '''
+        return self._heights
+
+
+    def last_y(self) -> np.ndarray:
+        ''' (N,) row (counted from the top, as C4Engine._last_y) of the last piece, -1 before first move '''
+        return self._last_y
+
+
+    def results(self) -> np.ndarray:
+        ''' (N,) result codes '''
+        return self._results
+
+
+    def turns(self) -> np.ndarray:
+        ''' (N,) index of the player to move (0 for A, 1 for B) '''
+        return self._num_moves % 2
+
+
+    def legal_moves(self) -> np.ndarray:
+        ''' (N, WIDTH) mask of columns that can be played '''
+        return (self._heights < C4Engine.HEIGHT) & (self._results == BatchC4Engine.NO_RESULT)[:, None]
+
+
+    def boards(self) -> np.ndarray:
+        ''' (N, HEIGHT, WIDTH) int8 boards, 0 - empty, 1 - A, 2 - B, first row is the top one '''
+        y = np.arange(C4Engine.HEIGHT)[::-1, None]
+        x = np.arange(C4Engine.WIDTH)[None, :]
+        bits = (x * BatchC4Engine._COLUMN_BITS + y).astype(np.uint64)
+        bb = self._bitboards[:, :, None, None]
+        cells = ((bb >> bits) & np.uint64(1)).astype(np.int8)
+        return cells[:, 0] + 2 * cells[:, 1]
+
+
+    def make_moves(self, cols: np.ndarray) -> np.ndarray:
+        '''
+        Play one column per game. Illegal moves (full column, finished game, out of range)
+        are ignored, negative columns mean no move. Returns (N,) mask of moves played.
+        '''
+        cols = np.asarray(cols, dtype=np.int64)
+        in_range = (cols >= 0) & (cols < C4Engine.WIDTH)
+        safe_cols = np.where(in_range, cols, 0)
+        idx = np.arange(self.n)
+        y = self._heights[idx, safe_cols]
+        played = in_range & (y < C4Engine.HEIGHT) & (self._results == BatchC4Engine.NO_RESULT)
+
+        idx, x, y = idx[played], safe_cols[played], y[played].astype(np.int64)
+        turn = self._num_moves[idx] % 2
+        bitboard = self._bitboards[idx, turn] | (np.uint64(1) << (x * BatchC4Engine._COLUMN_BITS + y).astype(np.uint64))
+        self._bitboards[idx, turn] = bitboard
+        self._heights[idx, x] += 1
+        self._num_moves[idx] += 1
+        self._last_y[idx] = C4Engine.HEIGHT - 1 - y
+
+        won = np.zeros(len(idx), dtype=bool)
+        for shift in C4Engine._DIRECTIONS:
+            pairs = bitboard & (bitboard >> np.uint64(shift))
+            won |= (pairs & (pairs >> np.uint64(2 * shift))) != 0
+        full = self._num_moves[idx] == C4Engine.WIDTH * C4Engine.HEIGHT
+        self._results[idx] = np.where(won, BatchC4Engine.RESULT_A + turn,
+                                      np.where(full, BatchC4Engine.RESULT_DRAW, BatchC4Engine.NO_RESULT))
+
+        return played
 
-        def in_bounds(x, y):
-            return 0 <= x < C4Engine.WIDTH and 0 <= y < C4Engine.HEIGHT
 
-        for dx, dy in dirs:
-            start_d = max(d for d in range(4) if in_bounds(move_x-d*dx, move_y-d*dy))
-            end_d = max(d for d in range(4) if in_bounds(move_x+d*dx, move_y+d*dy))
-            in_row = 0
-            for d in range(-start_d, end_d+1):
-                x = move_x + d*dx
-                y = move_y + d*dy
-                if self._board[y][x] == player:
-                    in_row += 1
-                else:
-                    in_row = 0
+    def legal_token_mask(self, meta: dict) -> np.ndarray:
+        ''' (N, vocab_size) mask of legal next tokens in the vocabulary from meta.pkl, see legal_token_mask '''
+        return legal_token_mask(meta, self._heights, self.turns(), self._results)
 
-                if in_row == 4:
-                    return player
 
-        return C4Engine.DRAW if C4Engine.EMPTY not in self._board[0] else None
+    def play(self, moves: np.ndarray) -> np.ndarray:
+        '''
+        Replay (N, T) column sequences, padded with negative values.
+        Returns (N, T) mask of moves played.
+        '''
+        moves = np.asarray(moves)
+        return np.stack([self.make_moves(moves[:, t]) for t in range(moves.shape[1])], axis=1)
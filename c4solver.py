@@ -0,0 +1,278 @@
+'''
+Perfect-play Connect-Four solver used as an evaluation oracle.
+
+Negamax with alpha-beta pruning on the C4Engine bitboard layout, following
+http://blog.gamesolver.org/ : non-losing move pruning, center-first move ordering
+(refined by the number of created threats), a bounded transposition table and
+iterative deepening of the score window with null-window searches.
+
+Scores are in the usual convention: positive if the player to move wins,
+(WIDTH*HEIGHT+1 - moves)/2 for winning with own last possible move, 0 for a draw.
+
+The search is pure Python, so its cost grows steeply towards the opening. Measured for
+analyze(weak=True) on val positions (one CPU core, shared table): about 15ms per position
+from ply 22, 50ms at ply 20 (up to ~0.7s), 0.35s at ply 18 (up to ~3s) and 1.4s at ply 16
+(up to ~20s); earlier plies take minutes. Keep min_ply >= 20 unless you can wait. Keying the
+table on min(key, mirror) was tried: mirrored positions almost never meet in the middle
+game, so it saved no nodes and cost ~30% in key computation.
+
+Example usage (score the moves played in the val split, starting from the 20th ply):
+$ python c4solver.py --dataset=connect_four_simple --min_ply=20
+'''
+import os
+import time
+from typing import List
+
+from c4engine import C4Engine
+
+WIDTH = C4Engine.WIDTH
+HEIGHT = C4Engine.HEIGHT
+SIZE = WIDTH * HEIGHT
+MIN_SCORE = -SIZE // 2 + 3
+
+BOTTOM_MASK = sum(1 << (x * (HEIGHT + 1)) for x in range(WIDTH))
+BOARD_MASK = BOTTOM_MASK * ((1 << HEIGHT) - 1)
+COLUMN_MASKS = [((1 << HEIGHT) - 1) << (x * (HEIGHT + 1)) for x in range(WIDTH)]
+COLUMN_ORDER = sorted(range(WIDTH), key=lambda x: abs(WIDTH // 2 - x)) # center first
+
+
+def _half(n: int) -> int:
+    # integer division truncating towards zero (as in C), used for score bounds
+    return int(n / 2)
+
+
+def winning_spots(position: int, mask: int) -> int:
+    ''' Bitmap of empty cells completing four-in-a-row for the owner of `position` '''
+    # vertical
+    r = (position << 1) & (position << 2) & (position << 3)
+    for s in (HEIGHT + 1, HEIGHT, HEIGHT + 2):
+        p = (position << s) & (position << 2*s)
+        r |= p & (position << 3*s)
+        r |= p & (position >> s)
+        p = (position >> s) & (position >> 2*s)
+        r |= p & (position << s)
+        r |= p & (position >> 3*s)
+    return r & (BOARD_MASK ^ mask)
+
+
+def possible_moves(mask: int) -> int:
+    ''' Bitmap of the cells where a piece can be dropped '''
+    return (mask + BOTTOM_MASK) & BOARD_MASK
+
+
+def non_losing_moves(position: int, mask: int) -> int:
+    ''' Bitmap of the moves that do not let the opponent win immediately '''
+    possible = possible_moves(mask)
+    opponent_win = winning_spots(position ^ mask, mask)
+    forced = possible & opponent_win
+    if forced:
+        if forced & (forced - 1):
+            return 0 # opponent has two immediate wins
+        possible = forced
+    return possible & ~(opponent_win >> 1) # don't play below an opponent's winning spot
+
+
+class TranspositionTable:
+    '''
+    Fixed size table of upper bounds keyed by the (position + mask) key.
+    Every slot holds two entries: a depth-preferred one, replaced only by positions
+    closer to the root (larger subtrees), and an always-replace one.
+    '''
+
+    def __init__(self, size: int = 1_000_003):
+        self.size = size
+        self.reset()
+
+
+    def reset(self) -> None:
+        self._keys = [0] * (2 * self.size)
+        self._values = [0] * (2 * self.size)
+        self._moves = [0] * (2 * self.size)
+
+
+    def put(self, key: int, value: int, moves: int) -> None:
+        i = 2 * (key % self.size)
+        if self._keys[i] == key or self._keys[i] == 0 or moves <= self._moves[i]:
+            self._keys[i], self._values[i], self._moves[i] = key, value, moves
+        else:
+            self._keys[i+1], self._values[i+1], self._moves[i+1] = key, value, moves
+
+
+    def get(self, key: int) -> int:
+        ''' Returns stored value or 0 if missing '''
+        i = 2 * (key % self.size)
+        if self._keys[i] == key:
+            return self._values[i]
+        if self._keys[i+1] == key:
+            return self._values[i+1]
+        return 0
+
+
+class Solver:
+
+    def __init__(self, tt_size: int = 1_000_003, book=None):
+        self.table = TranspositionTable(tt_size)
+        self.book = book # optional c4book.OpeningBook consulted before searching
+        self.node_count = 0
+
+
+    def reset(self) -> None:
+        self.table.reset()
+        self.node_count = 0
+
+
+    def _negamax(self, position: int, mask: int, moves: int, alpha: int, beta: int) -> int:
+        self.node_count += 1
+
+        candidates = non_losing_moves(position, mask)
+        if candidates == 0:
+            return -_half(SIZE - moves) # every move lets the opponent win
+
+        if moves >= SIZE - 2:
+            return 0 # draw, no one can win with the last two pieces
+
+        lower = -_half(SIZE - 2 - moves) # opponent can't win with his next move
+        if alpha < lower:
+            alpha = lower
+            if alpha >= beta:
+                return alpha
+
+        upper = _half(SIZE - 1 - moves) # we can't win with our next move
+        key = position + mask
+        stored = self.table.get(key)
+        if stored:
+            upper = stored + MIN_SCORE - 1
+        if beta > upper:
+            beta = upper
+            if alpha >= beta:
+                return beta
+
+        # order moves by the number of created winning spots, center first on ties
+        ordered = []
+        for x in COLUMN_ORDER:
+            move = candidates & COLUMN_MASKS[x]
+            if move:
+                ordered.append((-winning_spots(position | move, mask).bit_count(), len(ordered), move))
+        ordered.sort()
+
+        for _, _, move in ordered:
+            score = -self._negamax(position ^ mask, mask | move, moves + 1, -beta, -alpha)
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+
+        self.table.put(key, alpha - MIN_SCORE + 1, moves)
+        return alpha
+
+
+    def _solve(self, position: int, mask: int, moves: int, weak: bool = False) -> int:
+        if winning_spots(position, mask) & possible_moves(mask):
+            return 1 if weak else _half(SIZE + 1 - moves)
+
+        lower, upper = -_half(SIZE - moves), _half(SIZE + 1 - moves)
+        if weak:
+            lower, upper = -1, 1
+
+        # iterative deepening: null-window searches narrowing [lower, upper],
+        # probing near-terminal scores (shallow wins and losses) first
+        while lower < upper:
+            med = lower + _half(upper - lower)
+            if med <= 0 and _half(lower) < med:
+                med = _half(lower)
+            elif med >= 0 and _half(upper) > med:
+                med = _half(upper)
+            score = self._negamax(position, mask, moves, med, med + 1)
+            if score <= med:
+                upper = score
+            else:
+                lower = score
+        return (lower > 0) - (lower < 0) if weak else lower
+
+
+    @staticmethod
+    def _position(engine: C4Engine) -> tuple[int, int, int]:
+        if engine.result() is not None:
+            raise ValueError(f'game already finished with result {engine.result()}')
+        position = engine._bitboards[engine._turn]
+        mask = engine._bitboards[0] | engine._bitboards[1]
+        return position, mask, engine._num_moves
+
+
+    def solve(self, engine: C4Engine, weak: bool = False) -> int:
+        '''
+        Exact score of the position for the player to move.
+        With weak=True only the sign is computed (-1 loss, 0 draw, 1 win), which is faster.
+        '''
+        position = self._position(engine)
+        score = self.book.lookup(engine) if self.book is not None else None
+        if score is not None:
+            return (score > 0) - (score < 0) if weak else score
+        return self._solve(*position, weak=weak)
+
+
+    def analyze(self, engine: C4Engine, weak: bool = False) -> List[int | None]:
+        ''' Score of every column for the player to move, None for illegal moves '''
+        position, mask, moves = self._position(engine)
+        scores = []
+        for x in range(WIDTH):
+            move = possible_moves(mask) & COLUMN_MASKS[x]
+            if not move:
+                scores.append(None)
+            elif winning_spots(position, mask) & move:
+                scores.append(1 if weak else _half(SIZE + 1 - moves))
+            elif self.book is not None and moves < self.book.max_ply:
+                child = engine.copy()
+                child.make_move(str(x))
+                scores.append(-self.solve(child, weak=weak))
+            else:
+                scores.append(-self._solve(position ^ mask, mask | move, moves + 1, weak=weak))
+        return scores
+
+
+    def best_moves(self, engine: C4Engine) -> List[int]:
+        ''' Columns with the optimal score '''
+        scores = self.analyze(engine)
+        best = max(s for s in scores if s is not None)
+        return [x for x, s in enumerate(scores) if s == best]
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    dataset = 'connect_four_simple'
+    split = 'val' # 'train' or 'val', same 90/10 split as in prepare.py
+    min_ply = 20 # only score moves made after this many pieces are on the board, see the module docstring for the cost
+    max_games = -1 # -1 for all games in the split
+    tt_size = 1_000_003
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    with open(os.path.join('data', dataset, 'input.txt'), 'r') as f:
+        data = f.read().strip().split('\n')
+    split_n = int(len(data)*0.9)
+    data = data[:split_n] if split == 'train' else data[split_n:]
+    if max_games >= 0:
+        data = data[:max_games]
+    # every token starts with its move character (see stom in prepare.py)
+    games = [''.join(t[0] for t in (g.split() if ' ' in g else g)) for g in data]
+
+    if min_ply < 20:
+        print(f"warning: min_ply {min_ply} < 20, positions can take seconds to minutes each (see the c4solver.py docstring)")
+    solver = Solver(tt_size)
+    optimal, total = 0, 0
+    t0 = time.time()
+    for game in games:
+        engine = C4Engine(C4Engine.START)
+        for move in game[1:]:
+            if engine.result() is not None:
+                break
+            if engine._num_moves >= min_ply:
+                scores = solver.analyze(engine, weak=True)
+                best = max(s for s in scores if s is not None)
+                optimal += scores[int(move)] == best
+                total += 1
+            engine.make_move(move)
+    dt = time.time() - t0
+    print(f"Optimal moves ({split} data, ply >= {min_ply}): {optimal}/{total} ({100.0*optimal/max(total, 1):.2f}%)")
+    print(f"solved {total} positions in {dt:.2f}s ({1000*dt/max(total, 1):.2f}ms per position, {solver.node_count:,} nodes)")
+    print("the cost per position grows steeply with fewer pieces: ~15ms from ply 22, ~50ms at ply 20, ~0.35s at ply 18")
@@ -0,0 +1,100 @@
+"""
+Weights-only inference checkpoints and a shared, memoized model loader.
+
+ckpt.pt written by train.py holds the optimizer state next to the weights and only refers
+to the dataset by name. model.pt holds what inference needs:
+- 'model': state dict (without the '_orig_mod.' prefix of compiled models)
+- 'model_args': GPTConfig arguments
+- 'meta': the tokenizer meta of the dataset (contents of meta.pkl)
+- 'config': training config
+It contains only tensors and plain python values, so it is read with weights_only=True and
+memory-mapped (mmap=True): tensors are paged in from the file instead of being copied.
+
+train.py writes model.pt next to every ckpt.pt. For existing runs:
+$ python checkpoint.py --out_dir=out-connect-four-simple
+"""
+import functools
+import os
+import pickle
+
+import torch
+
+from model import GPTConfig, GPT
+
+CKPT_FILE = 'ckpt.pt'
+MODEL_FILE = 'model.pt'
+
+
+def strip_compile_prefix(state_dict: dict) -> dict:
+    """ state dict keys without the '_orig_mod.' prefix added by torch.compile """
+    unwanted_prefix = '_orig_mod.'
+    return {k[len(unwanted_prefix):] if k.startswith(unwanted_prefix) else k: v for k, v in state_dict.items()}
+
+
+def read_meta(dataset: str) -> dict | None:
+    """ meta.pkl of data/<dataset>, None if there is none """
+    meta_path = os.path.join('data', dataset, 'meta.pkl')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def export_checkpoint(checkpoint: dict, path: str, meta: dict | None = None) -> None:
+    """ write the inference checkpoint of a training checkpoint dict to path """
+    config = checkpoint.get('config', {})
+    if meta is None and 'dataset' in config:
+        meta = read_meta(config['dataset'])
+    torch.save({
+        'model': strip_compile_prefix(checkpoint['model']),
+        'model_args': checkpoint['model_args'],
+        'meta': meta,
+        'config': config,
+    }, path)
+
+
+@functools.lru_cache(maxsize=16)
+def _load(path: str, device: str, mtime: float):
+    if os.path.basename(path) == MODEL_FILE:
+        checkpoint = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+        meta = checkpoint['meta']
+    else:
+        # training checkpoint: mmap avoids reading the optimizer state
+        checkpoint = torch.load(path, map_location='cpu', mmap=True)
+        meta = read_meta(checkpoint['config']['dataset']) if 'dataset' in checkpoint.get('config', {}) else None
+
+    with torch.device('meta'):
+        model = GPT(GPTConfig(**checkpoint['model_args'])) # no memory and no random init for weights about to be replaced
+    model.load_state_dict(strip_compile_prefix(checkpoint['model']), assign=True)
+    model.lm_head.weight = model.transformer.wte.weight # assign gave the tied weights separate parameters
+    model.eval()
+    model.to(device)
+    return model, meta, checkpoint.get('config', {})
+
+
+def load_model(out_dir: str, device: str = 'cpu'):
+    """
+    (model, meta, config) of the run in out_dir (or of a checkpoint file), in eval mode on device.
+    model.pt is preferred over ckpt.pt. Results are memoized per path, device and modification
+    time of the file (a newer checkpoint is loaded again), so the same model object is returned
+    on every call: callers must not modify it in place (cpu_inference.prepare_model copies it).
+    """
+    path = out_dir
+    if os.path.isdir(out_dir):
+        path = os.path.join(out_dir, MODEL_FILE)
+        if not os.path.exists(path):
+            path = os.path.join(out_dir, CKPT_FILE)
+    path = os.path.abspath(path)
+    return _load(path, device, os.path.getmtime(path))
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    out_dir = 'out'
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    ckpt_path = os.path.join(out_dir, CKPT_FILE)
+    model_path = os.path.join(out_dir, MODEL_FILE)
+    export_checkpoint(torch.load(ckpt_path, map_location='cpu', mmap=True), model_path)
+    print(f"wrote {model_path} ({os.path.getsize(model_path) / 2**20:.2f} MiB, {ckpt_path}: {os.path.getsize(ckpt_path) / 2**20:.2f} MiB)")
@@ -0,0 +1,120 @@
+"""
+CPU inference for GPT models: int8 dynamic quantization, bf16 autocast and thread settings.
+
+Modes (see prepare_model):
+- 'fp32': the model as trained
+- 'bf16': fp32 weights, matmuls under torch.autocast(device_type='cpu', dtype=torch.bfloat16),
+  only used when the CPU has native bf16 support (falls back to fp32 otherwise)
+- 'int8': nn.Linear layers of the attention and MLP blocks replaced by dynamically quantized
+  int8 layers (weights quantized once, activations per call). lm_head is left in fp32, its
+  weight is tied to the token embedding.
+
+Running the file compares the modes on a split: latency of a single next-move prediction
+(as in play.py), throughput of evaluate.py and the legal move / result accuracy, plus the
+fraction of argmax predictions that agree with fp32.
+
+Example usage:
+$ python cpu_inference.py --out_dir=out-connect-four-simple --num_threads=4
+"""
+import copy
+import os
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from model import GPT
+
+MODES = ('fp32', 'bf16', 'int8')
+
+
+def bf16_supported() -> bool:
+    """ True if the CPU has native bf16 instructions (AVX512-BF16 / AMX) """
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+def set_num_threads(num_threads: int = 0) -> int:
+    """ intra-op threads (0 - one per physical core as chosen by torch), single inter-op thread """
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1) # GPT forward has no independent ops to run in parallel
+    except RuntimeError:
+        pass # can only be set before the first parallel work
+    return torch.get_num_threads()
+
+
+def quantize(model: GPT) -> GPT:
+    """ copy of the model with the Linear layers of every block quantized to int8 """
+    model = copy.deepcopy(model).cpu().eval()
+    for block in model.transformer.h:
+        for module in (block.attn, block.mlp):
+            torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def prepare_model(model: GPT, mode: str = 'int8'):
+    """ (model, ctx) for CPU inference in the given mode, forward the model inside ctx; the given model is not modified """
+    assert mode in MODES, f"unknown mode {mode}, expected one of {MODES}"
+    if mode == 'int8':
+        return quantize(model), nullcontext()
+    model = copy.deepcopy(model).cpu().eval() # the model may be shared (checkpoint.load_model)
+    if mode == 'bf16' and bf16_supported():
+        return model, torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+    return model, nullcontext()
+
+
+@torch.no_grad()
+def move_latency(model, data: np.ndarray, ctx=nullcontext(), num_moves: int = 200) -> float:
+    """ mean seconds per single-game next token prediction over prefixes of the games in data """
+    rng = np.random.default_rng(0)
+    games = rng.integers(len(data), size=num_moves)
+    lengths = rng.integers(1, min(data.shape[1], model.config.block_size), size=num_moves)
+    prefixes = [torch.from_numpy(data[g, :l].astype(np.int64))[None] for g, l in zip(games, lengths)]
+    with ctx:
+        model(prefixes[0]) # warmup
+        t0 = time.perf_counter()
+        for x in prefixes:
+            model(x)
+    return (time.perf_counter() - t0) / num_moves
+
+
+if __name__ == '__main__':
+    from checkpoint import load_model
+    from evaluate import evaluate, predict_all
+    # -----------------------------------------------------------------------------
+    out_dir = 'out-connect-four-simple'
+    split = 'val'
+    modes = 'fp32,bf16,int8' # comma separated
+    num_threads = 0 # 0 - torch default
+    num_games = 0 # 0 - the whole split
+    batch_size = 512
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    print(f"threads: {set_num_threads(num_threads)}, native bf16: {bf16_supported()}")
+
+    # model
+    model, meta, config = load_model(out_dir)
+
+    data_dir = os.path.join('data', config['dataset'])
+    block_size = meta['block_size']
+    data = np.memmap(os.path.join(data_dir, f'{split}.bin'), dtype=np.uint16, mode='r').reshape(-1, block_size+1)
+    if num_games > 0:
+        data = data[:num_games]
+
+    reference = None
+    for mode in modes.split(','):
+        m, ctx = prepare_model(model, mode)
+        latency = move_latency(m, data, ctx)
+        t0 = time.time()
+        preds = predict_all(m, data.astype(np.int64), batch_size, 'cpu', ctx)
+        correct_legal, total_legal, correct_result, total_result = evaluate(m, data, meta, batch_size, 'cpu', ctx, preds)
+        dt = time.time() - t0
+        if reference is None:
+            reference = preds
+        print(f"{mode}: move latency {1000*latency:.2f}ms, evaluate {len(data)/dt:,.0f} games/s, "
+              f"legal {100.0*correct_legal/total_legal:.2f}%, result {100.0*correct_result/total_result:.2f}%, "
+              f"agreement with {modes.split(',')[0]} {100.0*(preds == reference).mean():.2f}%")
@@ -3,13 +3,18 @@ Prepare the Connect-Four dataset for character-level language modeling.
 Each token represents a single move in the game or is a special token
 representing start of the game (S) or the game result (A/B/D).
 Moves encode column and player (e.g. 1a 3b ...).
-Will save train.bin, val.bin containing the ids, and meta.pkl containing the
+Will save train.bin, val.bin containing the ids, train_lengths.bin, val_lengths.bin
+containing the lengths of the games, and meta.pkl containing the
 encoder and decoder and some other related info.
 '''
 import os
+import sys
 import pickle
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+from tokenizer import build_meta
+
 # read data
 input_file_path = os.path.join(os.path.dirname(__file__), 'input.txt')
 with open(input_file_path, 'r') as f:
@@ -24,19 +29,16 @@ print(f'length of dataset in moves: {sum(len(d) for d in data):,}')
 max_game_len = max(len(d) for d in data)
 print(f'max game length: {max_game_len}')
 
-# vocab
-tokens = 'S A B D'.split() + [m + p for m in '0123456' for p in 'ab']
-vocab_size = len(tokens)
+# vocab, see tokenizer.py
+meta = build_meta('player', max_game_len)
+tokens = list(meta['itos'].values())
+vocab_size = meta['vocab_size']
 print('all the unique tokens:', ' '.join(tokens))
 print(f'vocab size: {vocab_size:,}')
 
-# create a mapping from tokens to integers and tokens to moves
-stoi = { t:i for i,t in enumerate(tokens) }
-itos = { i:t for i,t in enumerate(tokens) }
-stom = { t:t[0] for t in tokens}
-
+stoi, itos = meta['stoi'], meta['itos']
 def encode(s):
-    return [stoi[c] for c in s] # encoder: take a string, output a list of integers
+    return [stoi[c] for c in s] # encoder: take a list of tokens, output a list of integers
 def decode(l):
     return separator.join([itos[i] for i in l]) # decoder: take a list of integers, output a string
 
@@ -52,6 +54,10 @@ val_ids = [encode(g) for g in val_data]
 print(f'train has {len(train_ids):,} games ({sum(len(g) for g in train_ids):,} tokens)')
 print(f'val has {len(val_ids):,} games ({sum(len(g) for g in val_ids):,} tokens)')
 
+# lengths of the games, lets training skip the padding (see data_loader.py)
+np.array([len(g) for g in train_ids], dtype=np.uint8).tofile(os.path.join(os.path.dirname(__file__), 'train_lengths.bin'))
+np.array([len(g) for g in val_ids], dtype=np.uint8).tofile(os.path.join(os.path.dirname(__file__), 'val_lengths.bin'))
+
 # align length of each game to max - duplicate last token
 # using max_game_len + 1 to simplify training:
 # e.g:
@@ -69,17 +75,6 @@ train_ids.tofile(os.path.join(os.path.dirname(__file__), 'train.bin'))
 val_ids.tofile(os.path.join(os.path.dirname(__file__), 'val.bin'))
 
 # save the meta information as well, to help us encode/decode later
-eos_chars = 'ABD'
-meta = {
-    'vocab_size': vocab_size,
-    'itos': itos,
-    'stoi': stoi,
-    'stom': stom,
-    'separator': separator,
-    'block_size': max_game_len,
-    'eos_token_ids': encode(eos_chars),
-    'start_token': 'S',
-}
 with open(os.path.join(os.path.dirname(__file__), 'meta.pkl'), 'wb') as f:
     pickle.dump(meta, f)
 
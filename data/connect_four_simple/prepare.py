@@ -2,13 +2,18 @@
 Prepare the Connect-Four dataset for character-level language modeling.
 Each token represents a single move in the game or is a special token
 representing start of the game (S) or the game result (A/B/D).
-Will save train.bin, val.bin containing the ids, and meta.pkl containing the
+Will save train.bin, val.bin containing the ids, train_lengths.bin, val_lengths.bin
+containing the lengths of the games, and meta.pkl containing the
 encoder and decoder and some other related info.
 """
 import os
+import sys
 import pickle
 import numpy as np
 
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+from tokenizer import build_meta
+
 # read data
 input_file_path = os.path.join(os.path.dirname(__file__), 'input.txt')
 with open(input_file_path, 'r') as f:
@@ -19,16 +24,14 @@ print(f"length of dataset in characters: {len(''.join(data)):,}")
 max_game_len = max(len(d) for d in data)
 print(f"max game length: {max_game_len}")
 
-# vocab
-chars = '0123456ABDS'
-vocab_size = len(chars)
+# vocab, see tokenizer.py
+meta = build_meta('simple', max_game_len)
+chars = ''.join(meta['itos'].values())
+vocab_size = meta['vocab_size']
 print("all the unique characters:", chars)
 print(f"vocab size: {vocab_size:,}")
 
-# create a mapping from characters to integers and characters to moves
-stoi = { ch:i for i,ch in enumerate(chars) }
-itos = { i:ch for i,ch in enumerate(chars) }
-stom = { ch:ch for ch in chars}
+stoi, itos = meta['stoi'], meta['itos']
 def encode(s):
     return [stoi[c] for c in s] # encoder: take a string, output a list of integers
 def decode(l):
@@ -46,6 +49,10 @@ val_ids = [encode(g) for g in val_data]
 print(f"train has {len(train_ids):,} games ({sum(len(g) for g in train_ids)} tokens)")
 print(f"val has {len(val_ids):,} games ({sum(len(g) for g in val_ids)} tokens)")
 
+# lengths of the games, lets training skip the padding (see data_loader.py)
+np.array([len(g) for g in train_ids], dtype=np.uint8).tofile(os.path.join(os.path.dirname(__file__), 'train_lengths.bin'))
+np.array([len(g) for g in val_ids], dtype=np.uint8).tofile(os.path.join(os.path.dirname(__file__), 'val_lengths.bin'))
+
 # align length of each game to max - duplicate last token
 # using max_game_len + 1 to simplify training:
 # e.g:
@@ -63,17 +70,6 @@ train_ids.tofile(os.path.join(os.path.dirname(__file__), 'train.bin'))
 val_ids.tofile(os.path.join(os.path.dirname(__file__), 'val.bin'))
 
 # save the meta information as well, to help us encode/decode later
-eos_chars = 'ABD'
-meta = {
-    'vocab_size': vocab_size,
-    'itos': itos,
-    'stoi': stoi,
-    'stom': stom,
-    'separator': '',
-    'block_size': max_game_len,
-    'eos_token_ids': encode(eos_chars),
-    'start_token': 'S',
-}
 with open(os.path.join(os.path.dirname(__file__), 'meta.pkl'), 'wb') as f:
     pickle.dump(meta, f)
 
@@ -0,0 +1,344 @@
+"""
+In-memory batch loader for the padded game datasets (train.bin / val.bin of prepare.py).
+
+The split is read once into (N, block_size) input and target tensors (x = game[:-1], y = game[1:]),
+a few MB for our datasets. A batch is gathered with one index_select per tensor into one of a ring
+of preallocated (pinned, when training on cuda) buffers, which a background thread keeps filled
+prefetch batches ahead. The main thread only issues the (non-blocking) copy to the device; a buffer
+is refilled once its copy has finished.
+
+Samplers choose the games of every batch:
+- RandomSampler: uniformly with replacement (every process of a DDP run with its own seed)
+- EpochSampler: a seeded permutation of the split per epoch, shared by all processes, cut into
+  world_size disjoint contiguous shards of equal length (the len % world_size games left over are
+  not used in that epoch), each shard read in order by its rank. Batches continue into the next
+  epoch. Its position (epoch, offset in the shard) is saved with the checkpoints to resume exactly.
+
+Layouts of a batch (games are padded with their result token to block_size+1 tokens):
+- padded: (B, block_size), the loss includes predicting the padding
+- masked: (B, block_size), targets after the result token are -1 (ignore_index of the loss)
+- bucketed: masked, and the games of bucket_pool batches drawn at once are sorted by length and
+  split into batches (served in random order), each cut to its longest game rounded up to a
+  multiple of 4 tokens (few distinct shapes for torch.compile). In the middle of a pool the
+  position is the sampler position and generator state at the start of the pool and the number
+  of its batches served; the pool is drawn again on resume and continues with the next batch.
+Lengths of the games (start token to result token) are read from <split>_lengths.bin (written by
+prepare.py) or, if missing, computed from the padding.
+
+Mirror augmentation: with mirror > 0 every game of a batch is mirrored left/right (column c ->
+6-c, Tokenizer.mirror_ids) with probability mirror, after the batch is on the device, by one
+gather from the permutation table. mirror=1 mirrors the whole split (e.g. to evaluate on the
+mirrored val games).
+
+Measure against the previous get_batch of train.py (memmap reopened and rows stacked per batch),
+and the training throughput (game tokens/s of forward+backward of a small GPT) of every layout:
+$ python data_loader.py --dataset=connect_four_simple --batch_size=256
+"""
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+
+LAYOUTS = ('padded', 'masked', 'bucketed')
+
+
+def lengths_path(path: str) -> str:
+    """ per-game lengths (uint8) next to a split, e.g. data/connect_four_simple/train_lengths.bin """
+    return os.path.splitext(path)[0] + '_lengths.bin'
+
+
+def game_lengths(data: np.ndarray) -> np.ndarray:
+    """ lengths of (N, block_size+1) games padded by repeating their last token """
+    padding = (data == data[:, -1:])[:, ::-1].cumprod(axis=1).sum(axis=1) - 1
+    return data.shape[1] - padding
+
+
+def read_split(path: str, block_size: int) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """ inputs, targets (N, block_size) int64 and game lengths (N,) of a padded split (N games of block_size+1 tokens) """
+    data = np.fromfile(path, dtype=np.uint16).reshape(-1, block_size + 1).astype(np.int64)
+    if os.path.exists(lengths_path(path)):
+        lengths = np.fromfile(lengths_path(path), dtype=np.uint8).astype(np.int64)
+    else:
+        lengths = game_lengths(data)
+    return (torch.from_numpy(np.ascontiguousarray(data[:, :-1])), torch.from_numpy(np.ascontiguousarray(data[:, 1:])),
+            torch.from_numpy(lengths))
+
+
+class RandomSampler:
+
+    def __init__(self, n: int, seed: int = 1337):
+        self.n = n
+        self.generator = torch.Generator().manual_seed(seed)
+
+
+    def next(self, batch_size: int) -> torch.Tensor:
+        return torch.randint(self.n, (batch_size,), generator=self.generator)
+
+
+    def state_dict(self) -> dict:
+        return {}
+
+
+    def load_state_dict(self, state: dict) -> None:
+        pass
+
+
+class EpochSampler:
+
+    def __init__(self, n: int, seed: int = 1337, rank: int = 0, world_size: int = 1):
+        assert n >= world_size, 'every rank needs at least one game'
+        self.n = n
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.shard_size = n // world_size
+        self.epoch = 0
+        self.offset = 0 # games of the shard already returned in this epoch
+        self.shard = self._shard(0)
+
+
+    def _shard(self, epoch: int) -> torch.Tensor:
+        perm = torch.randperm(self.n, generator=torch.Generator().manual_seed(self.seed + epoch))
+        return perm[self.rank * self.shard_size:(self.rank + 1) * self.shard_size]
+
+
+    def next(self, batch_size: int) -> torch.Tensor:
+        parts = []
+        while batch_size > 0:
+            if self.offset == self.shard_size:
+                self.epoch, self.offset = self.epoch + 1, 0
+                self.shard = self._shard(self.epoch)
+            k = min(batch_size, self.shard_size - self.offset)
+            parts.append(self.shard[self.offset:self.offset + k])
+            self.offset += k
+            batch_size -= k
+        return torch.cat(parts)
+
+
+    def progress(self, state: dict) -> float:
+        """ epochs done at a position """
+        return state['epoch'] + state['offset'] / self.shard_size
+
+
+    def state_dict(self) -> dict:
+        return {'epoch': self.epoch, 'offset': self.offset, 'world_size': self.world_size}
+
+
+    def load_state_dict(self, state: dict) -> None:
+        self.epoch, self.offset = state['epoch'], state['offset']
+        if state['world_size'] != self.world_size:
+            # same progress through the epoch, the shards (and so the games left in it) differ
+            self.offset = min(self.offset * state['world_size'] // self.world_size, self.shard_size)
+        self.shard = self._shard(self.epoch)
+
+
+class BatchLoader:
+    """ batches of one split, prepared by a background thread """
+
+    def __init__(self, path: str, block_size: int, batch_size: int, device: str = 'cpu', prefetch: int = 2,
+                 sampling: str = 'random', seed: int = 1337, rank: int = 0, world_size: int = 1,
+                 layout: str = 'padded', bucket_pool: int = 64, mirror_table: torch.Tensor | None = None,
+                 mirror: float = 0.0):
+        assert layout in LAYOUTS, f'unknown layout {layout}, expected one of {LAYOUTS}'
+        self.x, self.y, self.lengths = read_split(path, block_size)
+        if layout != 'padded':
+            self.y[torch.arange(block_size)[None, :] >= self.lengths[:, None] - 1] = -1
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.device = device
+        self.pin = 'cuda' in device
+        self.layout = layout
+        self.bucket_pool = bucket_pool
+        if sampling == 'epoch':
+            self.sampler = EpochSampler(len(self.x), seed, rank, world_size)
+        else:
+            self.sampler = RandomSampler(len(self.x), seed + rank)
+        self.generator = torch.Generator().manual_seed(seed + rank) # order of the batches of a pool
+        self.pool = [] # bucketed: (games, sampler position after the batch) of the batches left in the pool
+        self.mirror = mirror
+        if mirror > 0:
+            assert mirror_table is not None, 'mirroring needs the token permutation table'
+            # one more entry: -1 (the ignored targets of the masked layouts) is mapped to itself
+            self.mirror_table = torch.cat([mirror_table, torch.tensor([-1])]).to(device)
+            self.mirror_generator = torch.Generator(device=device).manual_seed(seed + rank)
+        self.state = self.sampler.state_dict() # sampler position after the last batch returned by next
+        self.tokens = 0 # targets up to the result token (not counting the padding) of the last batch returned by next
+        # buffers[i]: (2, batch_size, block_size) - inputs and targets, copied to the device at once
+        self.buffers = [torch.empty((2, batch_size, block_size), dtype=torch.int64, pin_memory=self.pin)
+                        for _ in range(max(prefetch, 1) + 1)]
+        self.prefetch = prefetch
+        self.ready = queue.Queue() # (buffer index, batch length, sampler position after the batch, targets)
+        self.free = queue.Queue() # (buffer index, cuda event of its last copy or None)
+        for i in range(len(self.buffers)):
+            self.free.put((i, None))
+        self.worker = None # started by the first next, after a possible load_state_dict
+
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+
+    def state_dict(self) -> dict:
+        """ sampler position of the next batch to be returned (prefetched batches are not counted) """
+        return dict(self.state)
+
+
+    def load_state_dict(self, state: dict) -> None:
+        assert self.worker is None, 'the position can only be set before the first batch'
+        if 'served' in state and self.layout == 'bucketed':
+            # in the middle of a bucketed pool: draw it again, skip the batches already served
+            self.sampler.load_state_dict(state['pool_start'])
+            self.generator.set_state(state['generator'].cpu())
+            self._draw_pool()
+            self.pool = self.pool[state['served']:]
+            self.state = dict(state)
+        else:
+            self.sampler.load_state_dict(state.get('pool_start', state))
+            self.state = self.sampler.state_dict()
+
+
+    def progress(self, state: dict) -> float:
+        """ epochs done at a position (epoch sampling) """
+        if 'served' in state:
+            return self.sampler.progress(state['pool_start']) + state['served'] * self.batch_size / self.sampler.shard_size
+        return self.sampler.progress(state)
+
+
+    def _games(self) -> tuple[torch.Tensor, dict]:
+        if self.layout != 'bucketed':
+            ix = self.sampler.next(self.batch_size)
+            return ix, self.sampler.state_dict()
+        if not self.pool:
+            self._draw_pool()
+        return self.pool.pop(0)
+
+
+    def _draw_pool(self) -> None:
+        start = {'pool_start': self.sampler.state_dict(), 'generator': self.generator.get_state()}
+        games = self.sampler.next(self.batch_size * self.bucket_pool)
+        batches = games[torch.argsort(self.lengths[games], stable=True)].split(self.batch_size)
+        order = torch.randperm(len(batches), generator=self.generator).tolist()
+        # position after every batch: within this pool, or at the start of the next one
+        end = {'pool_start': self.sampler.state_dict(), 'generator': self.generator.get_state(), 'served': 0}
+        self.pool = [(batches[j], {**start, 'served': k + 1} if k < len(order) - 1 else end)
+                     for k, j in enumerate(order)]
+
+
+    def _fill(self, i: int) -> tuple[int, dict, int]:
+        ix, state = self._games()
+        T = self.block_size
+        if self.layout == 'bucketed':
+            T = min(T, -(-(int(self.lengths[ix].max()) - 1) // 4) * 4)
+        buffer = self._buffer(i, T)
+        torch.index_select(self.x[:, :T], 0, ix, out=buffer[0])
+        torch.index_select(self.y[:, :T], 0, ix, out=buffer[1])
+        return T, state, int((self.lengths[ix] - 1).sum())
+
+
+    def _buffer(self, i: int, T: int) -> torch.Tensor:
+        """ contiguous (2, batch_size, T) view of a buffer """
+        return self.buffers[i].view(-1)[:2 * self.batch_size * T].view(2, self.batch_size, T)
+
+
+    def _worker(self) -> None:
+        while True:
+            i, event = self.free.get()
+            if event is not None:
+                event.synchronize() # the previous batch in this buffer is still being copied
+            self.ready.put((i, *self._fill(i)))
+
+
+    def next(self) -> tuple[torch.Tensor, torch.Tensor]:
+        """ the next batch (x, y) on the device """
+        if self.prefetch > 0:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._worker, daemon=True)
+                self.worker.start()
+            i, T, self.state, self.tokens = self.ready.get()
+        else:
+            i, _ = self.free.get()
+            T, self.state, self.tokens = self._fill(i)
+        if self.pin:
+            batch = self._buffer(i, T).to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            batch = self._buffer(i, T).to(self.device, copy=True)
+            event = None
+        self.free.put((i, event))
+        if self.mirror > 0:
+            return self._mirror(batch[0], batch[1])
+        return batch[0], batch[1]
+
+
+    def _mirror(self, x: torch.Tensor, y: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        flip = torch.rand((len(x), 1), device=x.device, generator=self.mirror_generator) < self.mirror
+        return torch.where(flip, self.mirror_table[x], x), torch.where(flip, self.mirror_table[y], y)
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    dataset = 'connect_four_simple'
+    split = 'train'
+    batch_size = 256
+    block_size = 44
+    prefetch = 2
+    num_batches = 2000
+    num_steps = 50 # training steps per layout
+    n_layer, n_head, n_embd = 4, 4, 128 # model of the layout comparison
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+    path = os.path.join('data', dataset, f'{split}.bin')
+
+    def memmap_batch():
+        # the former get_batch of train.py
+        data = np.memmap(path, dtype=np.uint16, mode='r').reshape(-1, block_size+1)
+        ix = torch.randint(len(data), (batch_size,))
+        x = torch.stack([torch.from_numpy((data[i,:-1]).astype(np.int64)) for i in ix])
+        y = torch.stack([torch.from_numpy((data[i,1:]).astype(np.int64)) for i in ix])
+        if 'cuda' in device:
+            return x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
+        return x.to(device), y.to(device)
+
+    loader = BatchLoader(path, block_size, batch_size, device, prefetch)
+    timings = {}
+    for name, get in [('memmap per batch', memmap_batch), (f'BatchLoader (prefetch={prefetch})', loader.next)]:
+        get()
+        t0 = time.perf_counter()
+        for _ in range(num_batches):
+            x, y = get()
+        if 'cuda' in device:
+            torch.cuda.synchronize()
+        timings[name] = (time.perf_counter() - t0) / num_batches
+        print(f"{name:<30} {timings[name]*1e6:8.1f} us/batch")
+    base, new = timings.values()
+    print(f"speedup: {base / new:.1f}x")
+
+    from model import GPTConfig, GPT
+    vocab_size = int(np.fromfile(path, dtype=np.uint16).max()) + 1
+    for layout in LAYOUTS:
+        torch.manual_seed(1337)
+        model = GPT(GPTConfig(block_size=block_size, vocab_size=vocab_size, n_layer=n_layer, n_head=n_head, n_embd=n_embd))
+        model.to(device)
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+        loader = BatchLoader(path, block_size, batch_size, device, prefetch, layout=layout)
+        for step in range(num_steps + 1):
+            if step == 1: # the first step warms up
+                if 'cuda' in device:
+                    torch.cuda.synchronize()
+                t0, tokens = time.perf_counter(), 0
+            x, y = loader.next()
+            tokens += loader.tokens
+            _, loss = model(x, y)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+        if 'cuda' in device:
+            torch.cuda.synchronize()
+        dt = time.perf_counter() - t0
+        print(f"layout {layout:<10} {tokens / dt:12,.0f} game tokens/s, {dt / num_steps * 1000:.1f} ms/step")
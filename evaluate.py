@@ -0,0 +1,158 @@
+"""
+Evaluate legal move and game result prediction of a trained model on a whole split.
+
+Instead of generating one token per game prefix, every game is forwarded once and the
+argmax prediction is taken at all positions at once (teacher forcing); the predictions
+are checked against BatchC4Engine. The numbers are the same as the ones computed by
+test_legal_move_and_game_result_prediction in the test_model_*.ipynb notebooks, including
+how repeated prefixes are skipped:
+- every distinct move prefix is evaluated only once (first occurrence in data order)
+- for a game finishing at index k, the result is checked after its last move; the j-th
+  repetition of an identical game is checked j padding tokens later (its shorter prefixes
+  are already seen), input longer than block_size is cropped as in GPT.generate
+
+Example usage:
+$ python evaluate.py --out_dir=out-connect-four-simple
+"""
+import os
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+from c4engine import C4Engine, BatchC4Engine
+from checkpoint import load_model
+from tokenizer import Tokenizer
+
+
+def prefix_ids(moves: np.ndarray) -> np.ndarray:
+    """ (N, T) ids such that ids[g, i] == ids[h, i] iff moves[g, :i+1] == moves[h, :i+1] """
+    ids = np.zeros(moves.shape, dtype=np.int64)
+    prev = np.zeros(len(moves), dtype=np.int64)
+    for i in range(moves.shape[1]):
+        _, prev = np.unique(prev * (moves.max() + 1) + moves[:, i], return_inverse=True)
+        ids[:, i] = prev
+    return ids
+
+
+def first_occurrences(ids: np.ndarray) -> np.ndarray:
+    """ mask of rows whose id did not appear in any earlier row """
+    _, first = np.unique(ids, return_index=True)
+    mask = np.zeros(len(ids), dtype=bool)
+    mask[first] = True
+    return mask
+
+
+def occurrence_index(ids: np.ndarray) -> np.ndarray:
+    """ for every row the number of earlier rows with the same id """
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    group_start = np.r_[0, np.flatnonzero(sorted_ids[1:] != sorted_ids[:-1]) + 1]
+    starts = np.repeat(group_start, np.diff(np.r_[group_start, len(ids)]))
+    occurrence = np.empty(len(ids), dtype=np.int64)
+    occurrence[order] = np.arange(len(ids)) - starts
+    return occurrence
+
+
+@torch.no_grad()
+def predict_all(model, data: np.ndarray, batch_size: int, device: str, ctx=nullcontext()) -> np.ndarray:
+    """ (N, T) argmax next token prediction after every prefix data[:, :i+1] (cropped to block_size) """
+    N, T = data.shape
+    block_size = model.config.block_size
+    preds = np.zeros((N, T), dtype=np.int64)
+    L = min(T, block_size)
+    for b in range(0, N, batch_size):
+        x = torch.from_numpy(data[b:b+batch_size, :L].astype(np.int64)).to(device)
+        with ctx:
+            # targets are only passed to get the logits at every position
+            logits, _ = model(x, torch.zeros_like(x))
+        preds[b:b+batch_size, :L] = logits.argmax(dim=-1).cpu().numpy()
+        # longer prefixes: sliding window of the last block_size tokens
+        for i in range(L, T):
+            x = torch.from_numpy(data[b:b+batch_size, i+1-block_size:i+1].astype(np.int64)).to(device)
+            with ctx:
+                logits, _ = model(x)
+            preds[b:b+batch_size, i] = logits[:, -1].argmax(dim=-1).cpu().numpy()
+    return preds
+
+
+def evaluate(model, data: np.ndarray, meta: dict, batch_size: int = 512, device: str = 'cpu', ctx=nullcontext(), preds=None):
+    """
+    data: (N, T) token ids of padded games (train.bin / val.bin rows).
+    preds: predictions of predict_all for data, computed with the model if not given.
+    Returns correct_legal, total_legal, correct_result, total_result.
+    """
+    itos, stom = meta['itos'], meta['stom']
+    token_moves = np.array([stom[itos[i]] for i in range(meta['vocab_size'])])
+    tokenizer = Tokenizer(meta)
+    token_cols, token_results = tokenizer.token_cols, tokenizer.token_results
+    move_codes = np.unique(token_moves, return_inverse=True)[1]
+
+    N, T = data.shape
+    data = data.astype(np.int64)
+
+    # legality and result oracle after every prefix
+    engine = BatchC4Engine(N)
+    legal = np.zeros((N, T, C4Engine.WIDTH), dtype=bool)
+    results = np.zeros((N, T), dtype=np.int8)
+    for i in range(T):
+        engine.make_moves(token_cols[data[:, i]])
+        legal[:, i] = engine.legal_moves()
+        results[:, i] = engine.results()
+    finished = results != BatchC4Engine.NO_RESULT
+    last_move = finished.argmax(axis=1) # index of the move finishing the game
+
+    # which prefixes are evaluated
+    ids = prefix_ids(move_codes[data])
+    first = np.stack([first_occurrences(ids[:, i]) for i in range(T)], axis=1)
+    positions = np.arange(T)[None, :]
+    eval_legal = first & (positions < last_move[:, None])
+    result_pos = last_move + occurrence_index(ids[:, -1])
+    eval_result = positions == result_pos[:, None]
+
+    if preds is None:
+        preds = predict_all(model, data, batch_size, device, ctx)
+    pred_cols = token_cols[preds]
+    legal_ok = (pred_cols >= 0) & np.take_along_axis(legal, np.maximum(pred_cols, 0)[..., None], axis=2)[..., 0]
+    final_results = results[np.arange(N), last_move]
+    result_ok = token_results[preds] == final_results[:, None]
+
+    return (int((legal_ok & eval_legal).sum()), int(eval_legal.sum()),
+            int((result_ok & eval_result).sum()), int(eval_result.sum()))
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    out_dir = 'out-connect-four-simple'
+    splits = 'val,train' # comma separated
+    batch_size = 512
+    device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+    dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
+    compile = False # use PyTorch 2.0 to compile the model to be faster
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+    torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+    device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+    ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+    # model
+    model, meta, config = load_model(out_dir, device)
+    if compile:
+        model = torch.compile(model) # requires PyTorch 2.0 (optional)
+
+    # read dataset
+    data_dir = os.path.join('data', config['dataset'])
+    block_size = meta['block_size']
+
+    split_names = {'train': 'training', 'val': 'validation'}
+    for split in splits.split(','):
+        data = np.memmap(os.path.join(data_dir, f'{split}.bin'), dtype=np.uint16, mode='r').reshape(-1, block_size+1)
+        t0 = time.time()
+        correct_legal, total_legal, correct_result, total_result = evaluate(model, data, meta, batch_size, device, ctx)
+        print(f"Legal moves predicted ({split_names[split]} data): {correct_legal}/{total_legal} ({100.0*correct_legal/total_legal:.2f}%)")
+        print(f"Game result predicted ({split_names[split]} data): {correct_result}/{total_result} ({100.0*correct_result/total_result:.2f}%)")
+        print(f"evaluated {len(data):,} games in {time.time() - t0:.2f}s")
@@ -0,0 +1,167 @@
+'''
+Canonical store of Connect-Four games, independent of the tokenization.
+
+The store is a flat binary file: a header (magic, number of games, number of moves), the
+offset of every game in the move stream (uint64, number of games + 1), the BatchC4Engine result
+code of every game (uint8) and the columns of all moves packed at 3 bits each (a big-endian bit
+stream). GameStore memory-maps it and unpacks any subset of games with a few vectorized
+gathers, so it also scales to corpora that do not fit in RAM. That is about 22 bytes per game
+of 37 moves, against an input.txt and padded .bin files per encoding.
+
+GameStore.tokens produces the token ids of any encoding (tokenizer.py) on demand, in the
+layout of prepare.py: start token, moves, result token, padded with the last token to
+block_size+1 tokens. The script packs an input.txt of any encoding into a store and converts
+a store into a dataset directory (train.bin, val.bin, their lengths and meta.pkl, 90/10 split).
+
+Example usage:
+$ python game_store.py --input_path=data/connect_four_simple/input.txt --store_path=data/connect_four.c4g
+$ python game_store.py --store_path=data/connect_four.c4g --scheme=player --out_dataset=connect_four_player_store
+'''
+import os
+import pickle
+import time
+
+import numpy as np
+
+from c4engine import C4Engine, BatchC4Engine
+from tokenizer import Tokenizer, build_meta
+
+MAGIC = int.from_bytes(b'C4GAMES1', 'little')
+HEADER_SIZE = 3 * 8
+MOVE_BITS = 3
+MAX_MOVES = C4Engine.WIDTH * C4Engine.HEIGHT
+
+
+class GameStore:
+
+    def __init__(self, path: str):
+        header = np.fromfile(path, dtype=np.uint64, count=3)
+        if len(header) != 3 or header[0] != MAGIC:
+            raise ValueError(f'{path} is not a game store file')
+        self.num_games = int(header[1])
+        self.total_moves = int(header[2])
+        self.offsets = np.memmap(path, dtype=np.uint64, mode='r', offset=HEADER_SIZE, shape=(self.num_games + 1,))
+        offset = HEADER_SIZE + 8 * (self.num_games + 1)
+        if self.num_games:
+            self.results = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(self.num_games,))
+        else:
+            self.results = np.zeros(0, dtype=np.uint8)
+        offset += self.num_games
+        if self.total_moves:
+            self._moves = np.memmap(path, dtype=np.uint8, mode='r', offset=offset,
+                                    shape=(-(-self.total_moves * MOVE_BITS // 8),))
+        else:
+            self._moves = np.zeros(1, dtype=np.uint8)
+
+
+    def __len__(self) -> int:
+        return self.num_games
+
+
+    def _index(self, ix) -> np.ndarray:
+        return np.arange(self.num_games) if ix is None else np.asarray(ix, dtype=np.int64).reshape(-1)
+
+
+    def num_moves(self, ix=None) -> np.ndarray:
+        ''' moves (N,) of the games ix (all games if None) '''
+        ix = self._index(ix)
+        return (self.offsets[ix + 1] - self.offsets[ix]).astype(np.int64)
+
+
+    def columns(self, ix=None) -> tuple[np.ndarray, np.ndarray]:
+        ''' columns (N, T) (padded with -1 after the last move) and result codes (N,) of the games ix (all games if None) '''
+        ix = self._index(ix)
+        start = self.offsets[ix].astype(np.int64)
+        n = self.offsets[ix + 1].astype(np.int64) - start
+        T = int(n.max()) if len(ix) else 0
+        played = np.arange(T) < n[:, None]
+        # bit positions of every move, MOVE_BITS bits from the most significant one
+        bit = np.where(played, start[:, None] + np.arange(T), 0)[..., None] * MOVE_BITS + np.arange(MOVE_BITS)
+        bits = (self._moves[bit >> 3].astype(np.int64) >> (7 - (bit & 7))) & 1
+        cols = bits @ (1 << np.arange(MOVE_BITS - 1, -1, -1))
+        return np.where(played, cols, -1), self.results[ix].astype(np.int64)
+
+
+    def lengths(self, ix=None) -> np.ndarray:
+        ''' tokens (N,) of the games ix (all games if None): start token, moves and result token (if any) '''
+        ix = self._index(ix)
+        return self.num_moves(ix) + 1 + (self.results[ix] != BatchC4Engine.NO_RESULT)
+
+
+    def tokens(self, tokenizer: Tokenizer, ix=None, length: int | None = None) -> np.ndarray:
+        ''' (N, length) token ids of the games ix (all games if None), the train.bin layout with length=block_size+1 '''
+        cols, results = self.columns(ix)
+        length = length or int(self.lengths(ix).max()) + 1
+        return tokenizer.encode_columns(cols, results, length)
+
+
+def write_store(path: str, cols: np.ndarray, results: np.ndarray) -> None:
+    ''' store of games given as (N, T) columns (padded with -1 after the last move) and result codes (N,) '''
+    cols = np.asarray(cols, dtype=np.int64)
+    played = cols >= 0
+    offsets = np.concatenate([[0], np.cumsum(played.sum(axis=1))]).astype(np.uint64)
+    moves = cols[played].astype(np.uint8)
+    bits = (moves[:, None] >> np.arange(MOVE_BITS - 1, -1, -1).astype(np.uint8)) & 1
+    with open(path, 'wb') as f:
+        np.array([MAGIC, len(cols), len(moves)], dtype=np.uint64).tofile(f)
+        offsets.tofile(f)
+        np.asarray(results).astype(np.uint8).tofile(f)
+        np.packbits(bits.reshape(-1)).tofile(f)
+
+
+def parse_games(lines: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    ''' columns (N, MAX_MOVES) (padded with -1) and result codes (N,) of games in any encoding, e.g. S3341D or S 3a 3b 4a D '''
+    cols = np.full((len(lines), MAX_MOVES), -1, dtype=np.int64)
+    results = np.full(len(lines), BatchC4Engine.NO_RESULT, dtype=np.int64)
+    for i, line in enumerate(lines):
+        tokens = line.split() if ' ' in line else list(line)
+        assert tokens[0] == C4Engine.START, f'game {i} does not start with {C4Engine.START}: {line}'
+        if tokens[-1] in C4Engine.RESULT_TYPES:
+            results[i] = BatchC4Engine.RESULT_CODES.index(tokens[-1])
+            tokens = tokens[:-1]
+        cols[i, :len(tokens) - 1] = [int(t[0]) for t in tokens[1:]]
+    return cols, results
+
+
+def write_dataset(store: GameStore, scheme: str, out_dir: str, block_size: int = 0, chunk_size: int = 1 << 16) -> None:
+    ''' train.bin, val.bin, their lengths and meta.pkl of the store in an encoding, as prepare.py writes them '''
+    lengths = store.lengths()
+    block_size = block_size or int(lengths.max())
+    assert lengths.max() <= block_size, f'games of up to {lengths.max()} tokens do not fit in block_size {block_size}'
+    meta = build_meta(scheme, block_size)
+    tokenizer = Tokenizer(meta)
+    os.makedirs(out_dir, exist_ok=True)
+    split_n = int(len(store) * 0.9)
+    for split, (lo, hi) in [('train', (0, split_n)), ('val', (split_n, len(store)))]:
+        with open(os.path.join(out_dir, f'{split}.bin'), 'wb') as f:
+            for b in range(lo, hi, chunk_size):
+                ix = np.arange(b, min(b + chunk_size, hi))
+                store.tokens(tokenizer, ix, block_size + 1).astype(np.uint16).tofile(f)
+        lengths[lo:hi].astype(np.uint8).tofile(os.path.join(out_dir, f'{split}_lengths.bin'))
+    with open(os.path.join(out_dir, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f)
+    print(f"wrote {out_dir}: train has {split_n:,} games, val has {len(store) - split_n:,} games, block_size {block_size}")
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    input_path = '' # if set, pack the games of this input.txt (any encoding) into the store
+    store_path = 'data/connect_four.c4g'
+    scheme = '' # if set, convert the store to a dataset of this encoding: 'simple', 'player' or 'full'
+    out_dataset = '' # data/<out_dataset>/ of the converted store
+    block_size = 0 # of the converted store, 0 - the longest game
+    chunk_size = 1 << 16 # games converted at once
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+    if input_path:
+        t0 = time.time()
+        with open(input_path, 'r') as f:
+            cols, results = parse_games(f.read().strip().split('\n'))
+        write_store(store_path, cols, results)
+        print(f"packed {len(cols):,} games of {input_path} ({os.path.getsize(input_path):,} bytes) into {store_path} "
+              f"({os.path.getsize(store_path):,} bytes) in {time.time() - t0:.2f}s")
+    if scheme:
+        assert out_dataset, 'set --out_dataset, the directory of the converted store'
+        t0 = time.time()
+        write_dataset(GameStore(store_path), scheme, os.path.join('data', out_dataset), block_size, chunk_size)
+        print(f"converted in {time.time() - t0:.2f}s")
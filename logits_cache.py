@@ -0,0 +1,141 @@
+"""
+Cache of next-token logits (and optionally hidden states) keyed by token prefix.
+
+Prefixes are stored in a trie, so a lookup walks one dictionary per token. The total size
+of the stored tensors is bounded by max_bytes; least recently used entries are evicted
+first. CachedGPT puts the cache in front of a GPT model: only rows whose prefix is not
+cached are forwarded, in one batch.
+"""
+from collections import OrderedDict
+from typing import Sequence
+
+import torch
+
+
+class _TrieNode:
+    __slots__ = ('children', 'parent', 'token', 'logits', 'hidden')
+
+    def __init__(self, parent=None, token=None):
+        self.children = {}
+        self.parent = parent
+        self.token = token
+        self.logits = None
+        self.hidden = None
+
+
+class PrefixLogitsCache:
+
+    def __init__(self, max_bytes: int = 64 * 2**20):
+        self.max_bytes = max_bytes
+        self.clear()
+
+
+    def clear(self) -> None:
+        self._root = _TrieNode()
+        self._lru = OrderedDict() # nodes holding a value, least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return dict(entries=len(self), nbytes=self.nbytes, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, hit_rate=self.hits / lookups if lookups else 0.0)
+
+
+    def get(self, prefix: Sequence[int]) -> tuple[torch.Tensor, torch.Tensor | None] | None:
+        """ (logits, hidden) cached for the prefix, None if missing """
+        node = self._root
+        for token in prefix:
+            node = node.children.get(token)
+            if node is None:
+                break
+        if node is None or node.logits is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._lru.move_to_end(node)
+        return node.logits, node.hidden
+
+
+    def put(self, prefix: Sequence[int], logits: torch.Tensor, hidden: torch.Tensor | None = None) -> None:
+        size = logits.nelement() * logits.element_size() + (hidden.nelement() * hidden.element_size() if hidden is not None else 0)
+        if size > self.max_bytes:
+            return
+        node = self._root
+        for token in prefix:
+            child = node.children.get(token)
+            if child is None:
+                child = node.children[token] = _TrieNode(node, token)
+            node = child
+        if node.logits is not None:
+            self._drop_value(node)
+        node.logits, node.hidden = logits, hidden
+        self.nbytes += size
+        self._lru[node] = None
+        while self.nbytes > self.max_bytes:
+            oldest = next(iter(self._lru))
+            self._drop_value(oldest)
+            self._prune(oldest)
+            self.evictions += 1
+
+
+    def _drop_value(self, node: _TrieNode) -> None:
+        self.nbytes -= node.logits.nelement() * node.logits.element_size()
+        if node.hidden is not None:
+            self.nbytes -= node.hidden.nelement() * node.hidden.element_size()
+        node.logits, node.hidden = None, None
+        del self._lru[node]
+
+
+    def _prune(self, node: _TrieNode) -> None:
+        # remove nodes left without a value and without children
+        while node.parent is not None and node.logits is None and not node.children:
+            del node.parent.children[node.token]
+            node = node.parent
+
+
+class CachedGPT:
+    """ Next-token logits of a GPT model, served from a PrefixLogitsCache when possible """
+
+    def __init__(self, model, cache: PrefixLogitsCache | None = None, store_hidden: bool = False):
+        self.model = model
+        self.cache = cache if cache is not None else PrefixLogitsCache()
+        self.store_hidden = store_hidden
+
+
+    @torch.no_grad()
+    def next_logits(self, idx: torch.Tensor, return_hidden: bool = False):
+        """
+        Logits (b, vocab_size) of the token following every row of idx (LongTensor of shape (b,t)).
+        With return_hidden (requires store_hidden) also the last block output at the last position (b, n_embd).
+        """
+        assert not return_hidden or self.store_hidden, "hidden states are only kept with store_hidden=True"
+        prefixes = [tuple(row) for row in idx.tolist()]
+        cached = [self.cache.get(p) for p in prefixes]
+        missing = [i for i, c in enumerate(cached) if c is None]
+        if missing:
+            block_size = self.model.config.block_size
+            x = idx[missing, -block_size:]
+            if self.store_hidden:
+                last = self.model.config.n_layer - 1
+                with self.model.capture(layers=[last]) as captured:
+                    logits, _ = self.model(x)
+                hidden = captured['out'][last][:, -1].cpu()
+            else:
+                logits, _ = self.model(x)
+            logits = logits[:, -1].cpu()
+            for j, i in enumerate(missing):
+                value = (logits[j].clone(), hidden[j].clone() if self.store_hidden else None)
+                self.cache.put(prefixes[i], *value)
+                cached[i] = value
+        logits = torch.stack([c[0] for c in cached]).to(idx.device)
+        if return_hidden:
+            return logits, torch.stack([c[1] for c in cached]).to(idx.device)
+        return logits
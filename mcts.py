@@ -0,0 +1,163 @@
+'''
+Monte Carlo tree search player using a GPT model for policy and value.
+
+- policy prior: the model's next token distribution restricted to the legal move tokens
+- value: the model's distribution over the result tokens (A/B/D) after the position,
+  renormalized among them, as the expected result for the player who made the last move;
+  finished games are scored exactly by the engine
+- selection: PUCT, Q + c_puct * P * sqrt(N_parent) / (1 + N)
+
+Leaves are collected in batches of batch_size and evaluated with one model forward per batch.
+While a batch is collected, every node on a selected path gets a virtual loss (counted as
+visited and lost), which steers the following selections to other branches.
+'''
+import time
+import math
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+from c4engine import C4Engine
+from tokenizer import Tokenizer
+
+
+class _Node:
+    __slots__ = ('parent', 'move', 'prior', 'token', 'children', 'visits', 'value_sum')
+
+    def __init__(self, parent=None, move=None, prior=1.0, token=None):
+        self.parent = parent
+        self.move = move # column played to reach this node
+        self.prior = prior
+        self.token = token # token of the move in the model vocabulary
+        self.children = None # {column: _Node} once expanded
+        self.visits = 0
+        self.value_sum = 0.0 # sum of results for the player who made the move
+
+
+    def q(self) -> float:
+        return self.value_sum / self.visits if self.visits > 0 else 0.0
+
+
+class MCTS:
+
+    def __init__(self, model, meta: dict, c_puct: float = 1.5, batch_size: int = 16, virtual_loss: int = 1,
+                 device: str = 'cpu', ctx=nullcontext()):
+        self.model = model
+        self.meta = meta
+        self.c_puct = c_puct
+        self.batch_size = batch_size
+        self.virtual_loss = virtual_loss
+        self.device = device
+        self.ctx = ctx
+        self.tokenizer = Tokenizer(meta)
+        self.root = None
+
+
+    def search(self, engine: C4Engine, tokens: list[int], num_simulations: int = 800, time_limit: float = 0) -> str:
+        '''
+        Best move (column, as a string) for the position of engine, given as token ids in the model
+        vocabulary (starting with the start token). Stops after num_simulations evaluated leaves or
+        time_limit seconds (0 - no limit), whichever comes first.
+        '''
+        t0 = time.time()
+        engine = engine.copy()
+        self.root = _Node()
+        self._expand([(self.root, engine, list(tokens))])
+        simulations = 0
+        while simulations < num_simulations and not (time_limit > 0 and time.time() - t0 > time_limit):
+            batch = []
+            for _ in range(min(self.batch_size, num_simulations - simulations)):
+                path, moves = self._select(engine)
+                self._apply_virtual_loss(path, 1)
+                batch.append((path, moves))
+            leaves = {} # the same leaf can be selected more than once, it is evaluated once
+            pending = []
+            for path, moves in batch:
+                self._apply_virtual_loss(path, -1)
+                for m in moves:
+                    engine.make_move(m)
+                if engine.result() is not None:
+                    self._backup(path, self._terminal_value(engine))
+                else:
+                    leaves.setdefault(id(path[-1]), (path[-1], engine.copy(), self._tokens(path, tokens)))
+                    pending.append(path)
+                for _ in moves:
+                    engine.unmake_move()
+            values = dict(zip(leaves, self._expand(list(leaves.values()))))
+            for path in pending:
+                self._backup(path, values[id(path[-1])])
+            simulations += len(batch)
+        return str(max(self.root.children.values(), key=lambda n: n.visits).move)
+
+
+    def visit_counts(self) -> dict[int, int]:
+        ''' visits of every root move of the last search '''
+        return {move: child.visits for move, child in self.root.children.items()}
+
+
+    def _select(self, engine: C4Engine) -> tuple[list[_Node], list[str]]:
+        node, path, moves = self.root, [self.root], []
+        while node.children:
+            # at least 1: the priors decide the first descents from a freshly expanded node
+            sqrt_visits = math.sqrt(max(node.visits, 1))
+            node = max(node.children.values(),
+                       key=lambda c: c.q() + self.c_puct * c.prior * sqrt_visits / (1 + c.visits))
+            path.append(node)
+            moves.append(str(node.move))
+        return path, moves
+
+
+    def _apply_virtual_loss(self, path: list[_Node], sign: int) -> None:
+        for node in path[1:]:
+            node.visits += sign * self.virtual_loss
+            node.value_sum -= sign * self.virtual_loss
+
+
+    def _backup(self, path: list[_Node], value: float) -> None:
+        ''' value: result for the player who made the last move of the path '''
+        for node in reversed(path):
+            node.visits += 1
+            node.value_sum += value
+            value = -value
+
+
+    def _terminal_value(self, engine: C4Engine) -> float:
+        # the game can only be won by the player who made the last move
+        return 0.0 if engine.result() == C4Engine.DRAW else 1.0
+
+
+    def _tokens(self, path: list[_Node], tokens: list[int]) -> list[int]:
+        return list(tokens) + [node.token for node in path[1:]]
+
+
+    @torch.no_grad()
+    def _expand(self, leaves: list[tuple[_Node, C4Engine, list[int]]]) -> list[float]:
+        ''' add the children of all leaves with one model forward, return their values '''
+        if not leaves:
+            return []
+        lengths = [len(t) for _, _, t in leaves]
+        x = torch.zeros((len(leaves), max(lengths)), dtype=torch.long)
+        for i, (_, _, t) in enumerate(leaves):
+            x[i, :len(t)] = torch.tensor(t)
+        x = x.to(self.device)
+        with self.ctx:
+            # targets are only passed to get the logits at every position (sequences are right padded)
+            logits, _ = self.model(x, torch.zeros_like(x))
+        logits = logits[torch.arange(len(leaves)), torch.tensor(lengths) - 1].float()
+        probs = torch.softmax(logits, dim=-1).cpu().numpy()
+
+        values = []
+        for (leaf, engine, _), p in zip(leaves, probs):
+            player = engine._turn
+            cols = [x for x in range(C4Engine.WIDTH) if engine._heights[x] < C4Engine.HEIGHT]
+            toks = [self.tokenizer.move_ids[x, C4Engine.HEIGHT - 1 - engine._heights[x], player] for x in cols]
+            priors = p[toks]
+            priors = priors / priors.sum() if priors.sum() > 0 else np.full(len(cols), 1 / len(cols))
+            leaf.children = {x: _Node(leaf, x, prior, tok) for x, prior, tok in zip(cols, priors, toks)}
+
+            # value for the player who made the last move (the one not to move)
+            r = p[self.tokenizer.result_ids[1:]] # A, B, D
+            total = r.sum()
+            values.append(float((r[1 - player] - r[player]) / total) if total > 0 else 0.0)
+        return values
@@ -9,6 +9,7 @@ https://github.com/huggingface/transformers/blob/main/src/transformers/models/gp
 
 import math
 import inspect
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from typing import List
 
@@ -27,9 +28,60 @@ class LayerNorm(nn.Module):
     def forward(self, input):
         return F.layer_norm(input, self.weight.shape, self.weight, self.bias, 1e-5)
 
+class KVCache:
+    """ Per-layer key/value buffers preallocated to block_size, for incremental decoding """
+
+    def __init__(self, n_layer, max_len):
+        self.max_len = max_len
+        self.pos = 0 # number of positions already stored
+        self.k = [None] * n_layer
+        self.v = [None] * n_layer
+
+    def update(self, layer_idx, k, v):
+        # store k, v of shape (B, nh, T, hs) at the current position, return keys/values of all positions so far
+        B, nh, T, hs = k.size()
+        assert self.pos + T <= self.max_len, f"KV cache overflow: {self.pos + T} > {self.max_len}"
+        if self.k[layer_idx] is None:
+            # allocated lazily, so the buffers follow the device and (autocast) dtype of the model
+            self.k[layer_idx] = torch.zeros(B, nh, self.max_len, hs, dtype=k.dtype, device=k.device)
+            self.v[layer_idx] = torch.zeros(B, nh, self.max_len, hs, dtype=v.dtype, device=v.device)
+        self.k[layer_idx][:, :, self.pos:self.pos+T] = k
+        self.v[layer_idx][:, :, self.pos:self.pos+T] = v
+        return self.k[layer_idx][:, :, :self.pos+T], self.v[layer_idx][:, :, :self.pos+T]
+
+class ActivationCapture:
+    """
+    Collects intermediate tensors of selected layers during forward passes, see GPT.capture.
+    Captured tensors of the last forward are available as capture[name][layer_idx].
+    """
+    TENSORS = ('q', 'k', 'v', 'out')
+
+    def __init__(self, layers, tensors, device=None, callback=None):
+        assert all(t in self.TENSORS for t in tensors), f"unknown tensors {tensors}, available: {self.TENSORS}"
+        self.layers = set(layers)
+        self.tensors = set(tensors)
+        self.device = device
+        self.callback = callback
+        self.captured = {name: {} for name in tensors}
+
+    def record(self, name, layer_idx, tensor):
+        if name not in self.tensors or layer_idx not in self.layers:
+            return
+        tensor = tensor.detach()
+        if self.device is not None:
+            # copies to the CPU block: the tensor is read (or passed to the callback) right away
+            tensor = tensor.to(self.device, non_blocking=torch.device(self.device).type != 'cpu')
+        if self.callback is not None:
+            self.callback(name, layer_idx, tensor)
+        else:
+            self.captured[name][layer_idx] = tensor
+
+    def __getitem__(self, name):
+        return self.captured[name]
+
 class CausalSelfAttention(nn.Module):
 
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         assert config.n_embd % config.n_head == 0
         # key, query, value projections for all heads, but in a batch
@@ -42,9 +94,8 @@ class CausalSelfAttention(nn.Module):
         self.n_head = config.n_head
         self.n_embd = config.n_embd
         self.dropout = config.dropout
-        self.last_q = None
-        self.last_k = None
-        self.last_v = None
+        self.layer_idx = layer_idx
+        self.capture = None # ActivationCapture set by GPT.capture
         # flash attention make GPU go brrrrr but support is only in PyTorch >= 2.0
         self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention')
         if not self.flash:
@@ -53,7 +104,7 @@ class CausalSelfAttention(nn.Module):
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, cache=None):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -61,18 +112,29 @@ class CausalSelfAttention(nn.Module):
         k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        self.last_q = q.detach().cpu()
-        self.last_k = k.detach().cpu()
-        self.last_v = v.detach().cpu()
-
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
+        if self.capture is not None:
+            self.capture.record('q', self.layer_idx, q)
+            self.capture.record('k', self.layer_idx, k)
+            self.capture.record('v', self.layer_idx, v)
+
+        # with a KV cache the T queries sit at positions pos..pos+T-1 and attend to all cached keys
+        pos = 0
+        if cache is not None:
+            pos = cache.pos
+            k, v = cache.update(self.layer_idx, k, v)
+
+        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, pos+T) -> (B, nh, T, pos+T)
         if self.flash:
             # efficient attention using Flash Attention CUDA kernels
-            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout if self.training else 0, is_causal=True)
+            # (is_causal aligns the mask top-left, so an explicit mask is needed for a chunk after a non-empty cache)
+            attn_mask = None
+            if pos > 0 and T > 1:
+                attn_mask = torch.ones(T, pos + T, dtype=torch.bool, device=x.device).tril(diagonal=pos)
+            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=self.dropout if self.training else 0, is_causal=(pos == 0 and T > 1))
         else:
             # manual implementation of attention
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
+            att = att.masked_fill(self.bias[:,:,pos:pos+T,:pos+T] == 0, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
             y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
@@ -100,15 +162,15 @@ class MLP(nn.Module):
 
 class Block(nn.Module):
 
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         self.ln_1 = LayerNorm(config.n_embd, bias=config.bias)
-        self.attn = CausalSelfAttention(config)
+        self.attn = CausalSelfAttention(config, layer_idx)
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, cache=None):
+        x = x + self.attn(self.ln_1(x), cache)
         x = x + self.mlp(self.ln_2(x))
         return x
 
@@ -135,7 +197,7 @@ class GPT(nn.Module):
             wte = nn.Embedding(config.vocab_size, config.n_embd),
             wpe = nn.Embedding(config.block_size, config.n_embd),
             drop = nn.Dropout(config.dropout),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h = nn.ModuleList([Block(config, i) for i in range(config.n_layer)]),
             ln_f = LayerNorm(config.n_embd, bias=config.bias),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
@@ -175,19 +237,26 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, cache=None):
+        """
+        With a KVCache (see new_cache), idx holds only the tokens following the cached ones:
+        the whole prompt on the first call (prefill), then e.g. one token per step.
+        """
         device = idx.device
         b, t = idx.size()
-        assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device) # shape (t)
+        start = cache.pos if cache is not None else 0
+        assert start + t <= self.config.block_size, f"Cannot forward sequence of length {start + t}, block size is only {self.config.block_size}"
+        pos = torch.arange(start, start + t, dtype=torch.long, device=device) # shape (t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
         pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
         for block in self.transformer.h:
-            x = block(x)
+            x = block(x, cache)
         x = self.transformer.ln_f(x)
+        if cache is not None:
+            cache.pos += t
 
         if targets is not None:
             # if we are given some desired targets also calculate the loss
@@ -310,20 +379,90 @@ class GPT(nn.Module):
         mfu = flops_achieved / flops_promised
         return mfu
 
+    @contextmanager
+    def capture(self, layers=None, tensors=('out',), device=None, callback=None):
+        """
+        Capture intermediate tensors during the forward passes run inside the with block:
+        'q', 'k', 'v' - attention projections of shape (b, nh, t, hs), 'out' - block outputs (b, t, n_embd).
+        layers: indices of the blocks to capture (default: all). Tensors stay on their device
+        unless device is given. With a callback(name, layer_idx, tensor) every captured tensor is
+        streamed to it instead of being kept. Outside of capture the forward does no extra copies.
+        Example:
+        >>> with model.capture(tensors=('out', 'k')) as captured:
+        ...     model(idx)
+        >>> captured['out'][0] # output of the first block
+        """
+        layers = range(self.config.n_layer) if layers is None else layers
+        capture = ActivationCapture(layers, tensors, device, callback)
+        handles = []
+        for i in capture.layers:
+            block = self.transformer.h[i]
+            if capture.tensors & {'q', 'k', 'v'}:
+                block.attn.capture = capture
+            if 'out' in capture.tensors:
+                handles.append(block.register_forward_hook(lambda module, input, output, i=i: capture.record('out', i, output)))
+        try:
+            yield capture
+        finally:
+            for handle in handles:
+                handle.remove()
+            for block in self.transformer.h:
+                block.attn.capture = None
+
+    def new_cache(self):
+        return KVCache(self.config.n_layer, self.config.block_size)
+
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def step(self, token, cache):
+        """
+        Feed one token per sequence (LongTensor of shape (b,) or (b,1)) after the tokens already
+        in the cache, return the logits for the next token, shape (b, vocab_size).
+        """
+        if token.dim() == 1:
+            token = token[:, None]
+        logits, _ = self(token, cache=cache)
+        return logits[:, -1, :]
+
+    @torch.no_grad()
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_cache=True, return_lengths=False, eos_check_interval=8, token_mask=None):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_cache the prompt is forwarded once and then only the new token every step,
+        falling back to full forwards of the cropped context once block_size is exceeded.
+        Every row is finished independently once it samples one of config.eos_token_ids, after
+        which it is padded with its EOS token (like the games in prepare.py). Whether all rows are
+        finished is checked every eos_check_interval steps only, to avoid a device sync per step;
+        trailing columns of pure padding are cut off at the end. With return_lengths also
+        returns a LongTensor (b,) with the length of every row up to and including its EOS.
+        Constrained decoding: token_mask is a bool tensor (b, vocab_size) of allowed tokens, or a
+        function of the current idx returning such a tensor every step (e.g. built from
+        BatchC4Engine.legal_token_mask). Disallowed logits are set to -inf before top_k and
+        sampling; rows with no allowed token are left unconstrained.
         """
-        for _ in range(max_new_tokens):
+        eos_token_ids = torch.tensor(self.config.eos_token_ids, dtype=torch.long, device=idx.device)
+        # only EOS tokens sampled here finish a row, a prompt ending in one is still continued by the model
+        finished = torch.zeros(idx.size(0), dtype=torch.bool, device=idx.device)
+        lengths = torch.full((idx.size(0),), idx.size(1), dtype=torch.long, device=idx.device)
+        cache = self.new_cache() if use_cache else None
+        idx_cond = idx
+        for step in range(max_new_tokens):
+            if cache is not None and cache.pos + idx_cond.size(1) > self.config.block_size:
+                cache = None
+                idx_cond = idx
             # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
+            if idx_cond.size(1) > self.config.block_size:
+                idx_cond = idx_cond[:, -self.config.block_size:]
             # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
+            logits, _ = self(idx_cond, cache=cache)
             # pluck the logits at the final step and scale by desired temperature
             logits = logits[:, -1, :] / temperature
+            # optionally allow only the given tokens
+            if token_mask is not None:
+                mask = token_mask(idx) if callable(token_mask) else token_mask
+                mask = mask | ~mask.any(dim=-1, keepdim=True)
+                logits = logits.masked_fill(~mask, -float('Inf'))
             # optionally crop the logits to only the top k options
             if top_k is not None:
                 v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
@@ -332,9 +471,17 @@ class GPT(nn.Module):
             probs = F.softmax(logits, dim=-1)
             # sample from the distribution
             idx_next = torch.multinomial(probs, num_samples=1)
+            # finished rows keep repeating their EOS token
+            idx_next = torch.where(finished[:, None], idx[:, -1:], idx_next)
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
-            # terminate generation when EOS generated
-            if idx_next.item() in self.config.eos_token_ids: break
-
-        return idx
+            idx_cond = idx_next if cache is not None else idx
+            lengths += ~finished
+            finished |= torch.isin(idx_next[:, 0], eos_token_ids)
+            # terminate generation when all rows generated EOS
+            if len(self.config.eos_token_ids) > 0 and (step + 1) % eos_check_interval == 0 and finished.all():
+                break
+
+        if len(self.config.eos_token_ids) > 0:
+            idx = idx[:, :int(lengths.max())]
+        return (idx, lengths) if return_lengths else idx
@@ -1,83 +1,54 @@
 '''
 Play a game with GPT model
 '''
-import os
-import pickle
 import sys
 import torch
 import numpy as np
 from c4engine import C4Engine
-from model import GPTConfig, GPT
+from checkpoint import load_model
+from tokenizer import Tokenizer, TokenStream
 
 
 if __name__ == '__main__':
-    rng = np.random.default_rng()
-
-    DEVICE = 'cuda'
+    if len(sys.argv) not in (2, 3) or sys.argv[2:] not in ([], ['greedy'], ['mcts']):
+        sys.exit('usage: python play.py <out_dir> [greedy|mcts]')
+    out_dir = sys.argv[1]
+    opponent = sys.argv[2] if len(sys.argv) == 3 else 'greedy'
 
-    dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16'
-    torch.backends.cuda.matmul.allow_tf32 = True
-    torch.backends.cudnn.allow_tf32 = True
-    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
-    ctx = torch.amp.autocast(device_type=DEVICE, dtype=ptdtype)
+    rng = np.random.default_rng()
 
-    out_dir = sys.argv[1]
+    DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+    CPU_MODE = 'int8' # CPU only: 'fp32', 'bf16' or 'int8', see cpu_inference.py
+    MCTS_SIMULATIONS = 800 # mcts opponent: evaluated positions per move
+    MCTS_TIME_LIMIT = 5.0 # mcts opponent: seconds per move (0 - no limit)
 
     # load model
-    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
-    checkpoint = torch.load(ckpt_path, map_location=DEVICE)
-    gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
-    model.eval()
-    model.to(DEVICE)
+    model, meta, _ = load_model(out_dir, DEVICE)
+    if DEVICE == 'cuda':
+        dtype = 'bfloat16' if torch.cuda.is_bf16_supported() else 'float16'
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+        ctx = torch.amp.autocast(device_type=DEVICE, dtype=ptdtype)
+    else:
+        from cpu_inference import prepare_model, set_num_threads
+        set_num_threads()
+        model, ctx = prepare_model(model, CPU_MODE)
 
-    # read metadata
-    data_dir = os.path.join('data', checkpoint['config']['dataset'])
-    meta_path = os.path.join(data_dir, 'meta.pkl')
-    with open(meta_path, 'rb') as f:
-        meta = pickle.load(f)
+    tokenizer = Tokenizer(meta)
 
-    # get encode/decode - tokenizer
-    vocab_size = meta['vocab_size']
-    stoi, itos, stom, separator = meta['stoi'], meta['itos'], meta['stom'], meta['separator']
-    split = lambda s: list(s) if separator == '' else s.split(separator)
-    encode = lambda s: [stoi[c] for c in split(s)]
-    decode = lambda l: separator.join(itos[i] for i in l)
-    ids_to_moves = lambda l: ''.join(stom[itos[i]] for i in l)
-
-    # TODO: handle it cleaner, maybe add this mapping to meta
-    def simple_moves_to_model_encoding(moves: str):
-        if vocab_size == 11: # simple model
-            return encode(moves)
-        if vocab_size == 18: # player model
-            result_moves = []
-            for i,m in enumerate(moves):
-                if m in C4Engine.START + C4Engine.RESULT_TYPES:
-                    result_moves.append(m)
-                else:
-                    result_moves.append(f'{m}{'a' if i % 2 == 1 else 'b'}')
-            return encode(separator.join(result_moves))
-        if vocab_size == 88: # full model
-            result_moves = []
-            eng = C4Engine()
-            for i,m in enumerate(moves):
-                eng.make_move(m)
-                if m in C4Engine.START + C4Engine.RESULT_TYPES:
-                    result_moves.append(m)
-                else:
-                    result_moves.append(f'{m}{eng._last_y}{'a' if i % 2 == 1 else 'b'}')
-            return encode(separator.join(result_moves))
+    if opponent == 'mcts':
+        from mcts import MCTS
+        mcts = MCTS(model, meta, device=DEVICE, ctx=ctx)
+    else:
+        # positions repeat a lot between games, keep the model outputs of seen prefixes
+        from logits_cache import CachedGPT
+        cached_model = CachedGPT(model)
 
     # game loop
     while True:
-        prefix = 'S'
-        engine = C4Engine(prefix)
+        engine = C4Engine('S')
+        stream = TokenStream(tokenizer) # the game in the model vocabulary
         player = 'A' if rng.random() < 0.5 else 'B'
 
         print('You play as', player)
@@ -88,18 +59,23 @@ if __name__ == '__main__':
                 while True:
                     move = input(f'Your move ({player}): ')
                     if engine.make_move(move):
-                        prefix += move
+                        stream.push(int(move))
                         print('\n'.join(''.join(row) for row in engine.board()))
                         break
                     else:
                         print('This move is illegal!')
                         continue
             else:
-                x = (torch.tensor(simple_moves_to_model_encoding(prefix), dtype=torch.long, device=DEVICE)[None, ...])
-                y = model.generate(idx=x, max_new_tokens=1, top_k=1)
-                move = ids_to_moves(y[0].tolist())[-1]
+                if opponent == 'mcts':
+                    move = mcts.search(engine, stream.ids, MCTS_SIMULATIONS, MCTS_TIME_LIMIT)
+                else:
+                    x = torch.tensor(stream.ids, dtype=torch.long, device=DEVICE)[None, ...]
+                    legal = torch.tensor(engine.legal_token_mask(meta), device=DEVICE)[None, ...]
+                    with ctx:
+                        logits = cached_model.next_logits(x).float().masked_fill(~legal, -float('Inf'))
+                    move = str(tokenizer.token_cols[logits.argmax(dim=-1).item()])
                 if engine.make_move(move):
-                    prefix += move
+                    stream.push(int(move))
                     print(f'Player {curr_player} (GPT): {move}')
                     print('\n'.join(''.join(row) for row in engine.board()))
                 else:
@@ -0,0 +1,197 @@
+"""
+Extract probing datasets: activations of every layer for every position of every game,
+with board labels, streamed to memory-mapped files on disk.
+
+Games are forwarded in batches with GPT.capture, labels (cell values, pieces per column,
+pieces per row) are computed for all games at once with BatchC4Engine. Positions go from
+the start token up to and including the result token (the padding is skipped); with dedup
+only the first occurrence of every move prefix is kept, as in the notebooks.
+
+Layout of <probe_dir>/<split>/:
+- index.pkl: number of samples, shapes, dtypes and the list of files
+- samples.bin: int32 (S, 2) game index and position of every sample
+- cell.bin, col.bin, row.bin: int8 labels (S, 42), (S, 7), (S, 6)
+- block_<i>.bin: (S, n_embd) output of block i at the sample position
+- block_<i>_k.bin, block_<i>_v.bin: (G, T, n_embd) keys/values of block i for every game,
+  the keys/values of a sample are the first position+1 rows of its game
+
+Example usage:
+$ python probe_data.py --out_dir=out-connect-four-simple --splits=train,val
+"""
+import os
+import pickle
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+from c4engine import C4Engine, BatchC4Engine
+from evaluate import prefix_ids, first_occurrences
+from checkpoint import load_model
+from tokenizer import Tokenizer
+
+TARGETS = {'cell': C4Engine.WIDTH * C4Engine.HEIGHT, 'col': C4Engine.WIDTH, 'row': C4Engine.HEIGHT}
+
+
+def board_labels(data: np.ndarray, meta: dict) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Labels after every prefix of (N, T) padded games: cell values (N, T, 42) (0 - empty, 1 - A, 2 - B),
+    pieces per column (N, T, 7), pieces per row (N, T, 6) and the index of the result token (N,).
+    """
+    token_cols = Tokenizer(meta).token_cols
+    N, T = data.shape
+    cell = np.zeros((N, T, TARGETS['cell']), dtype=np.int8)
+    col = np.zeros((N, T, TARGETS['col']), dtype=np.int8)
+    row = np.zeros((N, T, TARGETS['row']), dtype=np.int8)
+    finished = np.zeros((N, T), dtype=bool)
+    engine = BatchC4Engine(N)
+    for i in range(T):
+        engine.make_moves(token_cols[data[:, i]])
+        boards = engine.boards()
+        cell[:, i] = boards.reshape(N, -1)
+        col[:, i] = engine.heights()
+        row[:, i] = (boards != 0).sum(axis=2)
+        finished[:, i] = engine.results() != BatchC4Engine.NO_RESULT
+    result_pos = np.minimum(finished.argmax(axis=1) + 1, T - 1)
+    return cell, col, row, result_pos
+
+
+def extract(model, data: np.ndarray, meta: dict, path: str, dedup: bool = True, store_kv: bool = True,
+            batch_size: int = 256, device: str = 'cpu', ctx=nullcontext(), dtype: str = 'float16') -> None:
+    """ Write the probing dataset of the (N, T) games in data to directory path """
+    os.makedirs(path, exist_ok=True)
+    data = np.asarray(data, dtype=np.int64)
+    N = len(data)
+    T = min(data.shape[1], model.config.block_size)
+    data = data[:, :T]
+    n_layer, n_embd = model.config.n_layer, model.config.n_embd
+
+    cell, col, row, result_pos = board_labels(data, meta)
+    keep = np.arange(T)[None, :] <= result_pos[:, None]
+    if dedup:
+        move_codes = np.unique([meta['stom'][meta['itos'][i]] for i in range(meta['vocab_size'])], return_inverse=True)[1]
+        ids = prefix_ids(move_codes[data])
+        keep &= np.stack([first_occurrences(ids[:, i]) for i in range(T)], axis=1)
+    games, positions = np.nonzero(keep) # sample order: by game, then position
+    S = len(games)
+
+    def open_file(name, file_dtype, shape):
+        return np.memmap(os.path.join(path, name), dtype=file_dtype, mode='w+', shape=shape)
+
+    samples = open_file('samples.bin', np.int32, (S, 2))
+    samples[:] = np.stack([games, positions], axis=1)
+    for name, labels in (('cell', cell), ('col', col), ('row', row)):
+        out = open_file(f'{name}.bin', np.int8, (S, TARGETS[name]))
+        out[:] = labels[games, positions]
+        out.flush()
+    files = {f'block_{i}': open_file(f'block_{i}.bin', dtype, (S, n_embd)) for i in range(n_layer)}
+    if store_kv:
+        for i in range(n_layer):
+            files[f'block_{i}_k'] = open_file(f'block_{i}_k.bin', dtype, (N, T, n_embd))
+            files[f'block_{i}_v'] = open_file(f'block_{i}_v.bin', dtype, (N, T, n_embd))
+
+    # offsets of every game's samples, so each batch of games writes one contiguous block of rows
+    game_start = np.searchsorted(games, np.arange(N + 1))
+    tensors = ('out', 'k', 'v') if store_kv else ('out',)
+    with torch.no_grad():
+        for b in range(0, N, batch_size):
+            e = min(b + batch_size, N)
+            x = torch.from_numpy(data[b:e]).to(device)
+            with ctx, model.capture(tensors=tensors) as captured:
+                model(x)
+            rows = slice(game_start[b], game_start[e])
+            g = torch.from_numpy(games[rows] - b).to(device)
+            p = torch.from_numpy(positions[rows]).to(device)
+            for i in range(n_layer):
+                files[f'block_{i}'][rows] = captured['out'][i][g, p].float().cpu().numpy()
+                if store_kv:
+                    for name in ('k', 'v'):
+                        kv = captured[name][i] # (B, nh, T, hs)
+                        files[f'block_{i}_{name}'][b:e] = kv.transpose(1, 2).reshape(e - b, T, n_embd).float().cpu().numpy()
+
+    for f in files.values():
+        f.flush()
+    index = {
+        'num_samples': S,
+        'num_games': N,
+        'block_size': T,
+        'n_layer': n_layer,
+        'n_embd': n_embd,
+        'dtype': dtype,
+        'store_kv': store_kv,
+        'dedup': dedup,
+        'targets': TARGETS,
+        'files': ['samples.bin', 'cell.bin', 'col.bin', 'row.bin'] + [f'{name}.bin' for name in files],
+    }
+    with open(os.path.join(path, 'index.pkl'), 'wb') as f:
+        pickle.dump(index, f)
+
+
+class ProbeDataset:
+    """ Read-only memory-mapped view of a directory written by extract """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, 'index.pkl'), 'rb') as f:
+            self.index = pickle.load(f)
+        self.num_samples = self.index['num_samples']
+        self.samples = self._open('samples.bin', np.int32, (self.num_samples, 2))
+
+    def _open(self, name, dtype, shape):
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=shape)
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+    def labels(self, target: str) -> np.ndarray:
+        """ (S, dim) int8 labels, target is 'cell', 'col' or 'row' """
+        return self._open(f'{target}.bin', np.int8, (self.num_samples, self.index['targets'][target]))
+
+    def activations(self, layer: int) -> np.ndarray:
+        """ (S, n_embd) outputs of the block at every sample position """
+        return self._open(f'block_{layer}.bin', self.index['dtype'], (self.num_samples, self.index['n_embd']))
+
+    def kv(self, layer: int, rows: np.ndarray) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """ keys, values (n, T, n_embd) and mask (n, T) of the given samples, as in the attention probe notebooks """
+        assert self.index['store_kv'], "keys/values were not stored"
+        shape = (self.index['num_games'], self.index['block_size'], self.index['n_embd'])
+        games, positions = self.samples[rows, 0], self.samples[rows, 1]
+        mask = torch.from_numpy(np.arange(shape[1])[None, :] <= positions[:, None])
+        k = torch.from_numpy(self._open(f'block_{layer}_k.bin', self.index['dtype'], shape)[games].astype(np.float32))
+        v = torch.from_numpy(self._open(f'block_{layer}_v.bin', self.index['dtype'], shape)[games].astype(np.float32))
+        return k * mask[..., None], v * mask[..., None], mask
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    out_dir = 'out-connect-four-simple'
+    probe_dir = '' # defaults to <out_dir>/probe
+    splits = 'train,val' # comma separated
+    dedup = True # keep only the first occurrence of every move prefix
+    store_kv = True # also store keys/values of every game for attention probes
+    storage_dtype = 'float16' # dtype of the stored activations
+    batch_size = 256
+    device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+    dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+    torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+    device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+    ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+    # model
+    model, meta, config = load_model(out_dir, device)
+
+    data_dir = os.path.join('data', config['dataset'])
+    block_size = meta['block_size']
+    probe_dir = probe_dir or os.path.join(out_dir, 'probe')
+
+    for split in splits.split(','):
+        data = np.memmap(os.path.join(data_dir, f'{split}.bin'), dtype=np.uint16, mode='r').reshape(-1, block_size+1)
+        t0 = time.time()
+        extract(model, data, meta, os.path.join(probe_dir, split), dedup, store_kv, batch_size, device, ctx, storage_dtype)
+        print(f"{split}: wrote {len(ProbeDataset(os.path.join(probe_dir, split))):,} samples to {os.path.join(probe_dir, split)} in {time.time() - t0:.2f}s")
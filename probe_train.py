@@ -0,0 +1,167 @@
+"""
+Train linear board probes for all layers and all targets (cell, col, row) at once.
+
+The probes of all layers are one batched linear layer: weights (n_layer, n_embd, outputs)
+applied with bmm, where the outputs of all targets are concatenated (dim * num_cls each).
+Two solvers:
+- 'adam': minibatch cross-entropy training, a single loop over the cached activations
+- 'ridge': closed-form ridge regression on one-hot targets, accumulated in chunks on CPU
+
+Accuracies are returned per target as {f'block_{i}': tensor of shape (dim,)}, the format
+expected by plot_heatmaps in the notebooks.
+
+Example usage (after probe_data.py):
+$ python probe_train.py --probe_dir=out-connect-four-simple/probe --method=ridge
+"""
+import math
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from probe_data import ProbeDataset
+
+# number of classes of every target: cell value (empty/A/B), pieces in a column (0-6), pieces in a row (0-7)
+NUM_CLASSES = {'cell': 3, 'col': 7, 'row': 8}
+
+
+class MultiLinearProbe(nn.Module):
+    """ Independent linear probes for every layer and every target, applied as one bmm """
+
+    def __init__(self, n_layer, dim_x, dims_y, num_classes=NUM_CLASSES):
+        super().__init__()
+        self.targets = list(dims_y.keys())
+        self.dims_y = dims_y
+        self.num_classes = {t: num_classes[t] for t in self.targets}
+        n_out = sum(dims_y[t] * num_classes[t] for t in self.targets)
+        self.weight = nn.Parameter(torch.randn(n_layer, dim_x, n_out) / dim_x ** 0.5)
+        self.bias = nn.Parameter(torch.zeros(n_layer, 1, n_out))
+
+    def forward(self, x):
+        # x: (n_layer, B, dim_x) -> {target: (n_layer, B, dim_y, num_cls)}
+        out = torch.baddbmm(self.bias, x, self.weight)
+        L, B, _ = out.size()
+        logits = {}
+        for target, o in zip(self.targets, out.split([self.dims_y[t] * self.num_classes[t] for t in self.targets], dim=-1)):
+            logits[target] = o.view(L, B, self.dims_y[target], self.num_classes[target])
+        return logits
+
+
+def load_activations(dataset: ProbeDataset, layers, device) -> torch.Tensor:
+    """ (n_layer, S, n_embd) activations of the given layers, in the storage dtype """
+    return torch.stack([torch.from_numpy(np.array(dataset.activations(l))) for l in layers]).to(device)
+
+
+def train_probes_adam(dataset: ProbeDataset, targets=('cell', 'col', 'row'), epochs=1024, batch_size=1024,
+                      learning_rate=3e-4, weight_decay=1e-4, device='cpu', log_interval=200) -> MultiLinearProbe:
+    layers = range(dataset.index['n_layer'])
+    X = load_activations(dataset, layers, device)
+    Y = {t: torch.from_numpy(np.array(dataset.labels(t))).long().to(device) for t in targets}
+    probe = MultiLinearProbe(len(layers), X.size(-1), {t: Y[t].size(-1) for t in targets}).to(device)
+    optimizer = torch.optim.Adam(probe.parameters(), lr=learning_rate, weight_decay=weight_decay)
+
+    S = X.size(1)
+    for epoch in range(epochs):
+        total_loss = torch.zeros((), device=device) # accumulated on device, synced only when logging
+        perm = torch.randperm(S, device=device)
+        for i in range(0, S, batch_size):
+            idx = perm[i:i+batch_size]
+            logits = probe(X[:, idx].float())
+            loss = 0
+            for t in targets:
+                # sum over layers, so every layer's probe gets the gradient of its own mean loss
+                lt = logits[t]
+                loss = loss + F.cross_entropy(lt.reshape(-1, lt.size(-1)), Y[t][idx].repeat(len(layers), 1).view(-1)) * len(layers)
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+            total_loss += loss.detach()
+        if epoch % log_interval == 0 or epoch == epochs - 1:
+            print(f'Epoch {epoch:3d}: {total_loss.item() / math.ceil(S / batch_size) / len(layers):.4f}')
+    return probe
+
+
+def train_probes_ridge(dataset: ProbeDataset, targets=('cell', 'col', 'row'), l2=1e-2, chunk_size=65536) -> MultiLinearProbe:
+    """
+    Closed-form least squares fit of one-hot targets with ridge penalty l2 (scaled by the number
+    of samples), the class with the highest regression output is the prediction.
+    """
+    layers = range(dataset.index['n_layer'])
+    C = dataset.index['n_embd']
+    dims_y = {t: dataset.labels(t).shape[-1] for t in targets}
+    n_out = sum(dims_y[t] * NUM_CLASSES[t] for t in targets)
+    S = len(dataset)
+
+    # accumulate X^T X and X^T Y over chunks, with a constant 1 feature for the bias
+    XtX = torch.zeros(len(layers), C + 1, C + 1, dtype=torch.float64)
+    XtY = torch.zeros(len(layers), C + 1, n_out, dtype=torch.float64)
+    for i in range(0, S, chunk_size):
+        Y = torch.cat([F.one_hot(torch.from_numpy(np.array(dataset.labels(t)[i:i+chunk_size])).long(), NUM_CLASSES[t]).flatten(1)
+                       for t in targets], dim=1).double()
+        for l in layers:
+            x = torch.from_numpy(np.array(dataset.activations(l)[i:i+chunk_size])).double()
+            x = torch.cat([x, torch.ones(len(x), 1, dtype=torch.float64)], dim=1)
+            XtX[l] += x.T @ x
+            XtY[l] += x.T @ Y
+
+    reg = torch.eye(C + 1, dtype=torch.float64) * l2 * S
+    reg[-1, -1] = 0 # no penalty on the bias
+    W = torch.linalg.solve(XtX + reg, XtY) # (L, C+1, n_out)
+
+    probe = MultiLinearProbe(len(layers), C, dims_y)
+    with torch.no_grad():
+        probe.weight.copy_(W[:, :-1].float())
+        probe.bias.copy_(W[:, -1:].float())
+    return probe
+
+
+@torch.no_grad()
+def evaluate_probes(probe: MultiLinearProbe, dataset: ProbeDataset, device='cpu', chunk_size=65536) -> dict:
+    """ {target: {f'block_{i}': accuracy of every output (dim,)}} """
+    probe = probe.to(device)
+    layers = range(dataset.index['n_layer'])
+    correct = {t: torch.zeros(len(layers), probe.dims_y[t], device=device) for t in probe.targets}
+    S = len(dataset)
+    for i in range(0, S, chunk_size):
+        x = torch.stack([torch.from_numpy(np.array(dataset.activations(l)[i:i+chunk_size])) for l in layers]).to(device).float()
+        logits = probe(x)
+        for t in probe.targets:
+            y = torch.from_numpy(np.array(dataset.labels(t)[i:i+chunk_size])).long().to(device)
+            correct[t] += (logits[t].argmax(dim=-1) == y[None]).float().sum(dim=1)
+    return {t: {f'block_{l}': (correct[t][l] / S).cpu() for l in layers} for t in probe.targets}
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    probe_dir = 'out-connect-four-simple/probe' # written by probe_data.py
+    method = 'ridge' # 'ridge' or 'adam'
+    targets = 'cell,col,row' # comma separated
+    l2 = 1e-2 # ridge penalty
+    epochs = 1024 # adam only
+    batch_size = 1024 # adam only
+    learning_rate = 3e-4 # adam only
+    weight_decay = 1e-4 # adam only
+    device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    train_data = ProbeDataset(os.path.join(probe_dir, 'train'))
+    val_data = ProbeDataset(os.path.join(probe_dir, 'val'))
+    targets = tuple(targets.split(','))
+
+    t0 = time.time()
+    if method == 'ridge':
+        probe = train_probes_ridge(train_data, targets, l2)
+    else:
+        probe = train_probes_adam(train_data, targets, epochs, batch_size, learning_rate, weight_decay, device)
+    print(f"trained {len(targets)} probes for {train_data.index['n_layer']} layers in {time.time() - t0:.2f}s")
+
+    results = {}
+    for split, data in (('train', train_data), ('val', val_data)):
+        results[split] = evaluate_probes(probe, data, device if method == 'adam' else 'cpu')
+        for t in targets:
+            print(f"{split} {t}: " + ', '.join(f"{block} {acc.mean():.4f}" for block, acc in results[split][t].items()))
+    torch.save({'probe': probe.state_dict(), 'targets': targets, 'accuracies': results}, os.path.join(probe_dir, f'probe_{method}.pt'))
@@ -1,12 +1,10 @@
 """
 Sample from a trained model
 """
-import os
-import pickle
 from contextlib import nullcontext
 import torch
-import tiktoken
-from model import GPTConfig, GPT
+from model import GPT
+from checkpoint import load_model
 
 # -----------------------------------------------------------------------------
 init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
@@ -34,16 +32,7 @@ ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=
 # model
 if init_from == 'resume':
     # init from a model saved in a specific directory
-    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
-    checkpoint = torch.load(ckpt_path, map_location=device)
-    gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
+    model, meta, _ = load_model(out_dir, device)
 elif init_from.startswith('gpt2'):
     # init from a given GPT-2 model
     model = GPT.from_pretrained(init_from, dict(dropout=0.0))
@@ -53,16 +42,9 @@ model.to(device)
 if compile:
     model = torch.compile(model) # requires PyTorch 2.0 (optional)
 
-# look for the meta pickle in case it is available in the dataset folder
-load_meta = False
-if init_from == 'resume' and 'config' in checkpoint and 'dataset' in checkpoint['config']: # older checkpoints might not have these...
-    meta_path = os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
-    load_meta = os.path.exists(meta_path)
+# the tokenizer meta is stored with the model (older checkpoints might not have it...)
+load_meta = init_from == 'resume' and meta is not None
 if load_meta:
-    print(f"Loading meta from {meta_path}...")
-    with open(meta_path, 'rb') as f:
-        meta = pickle.load(f)
-
     stoi, itos, separator = meta['stoi'], meta['itos'], meta['separator']
     split = lambda s: list(s) if separator == '' else s.split(separator)
     encode = lambda s: [stoi[c] for c in split(s)]
@@ -73,6 +55,7 @@ if load_meta:
 else:
     # ok let's assume gpt-2 encodings by default
     print("No meta.pkl found, assuming GPT-2 encodings...")
+    import tiktoken # only needed for GPT-2 models
     enc = tiktoken.get_encoding("gpt2")
     encode = lambda s: enc.encode(s, allowed_special={"<|endoftext|>"})
     decode = lambda l: enc.decode(l)
@@ -82,12 +65,12 @@ if start.startswith('FILE:'):
     with open(start[5:], 'r', encoding='utf-8') as f:
         start = f.read()
 start_ids = encode(start)
-x = (torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...])
+x = (torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...]).repeat(num_samples, 1)
 
-# run generation
+# run generation, all samples in one batch
 with torch.no_grad():
     with ctx:
+        y, lengths = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, return_lengths=True)
         for k in range(num_samples):
-            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
-            print(decode(y[0].tolist()))
+            print(decode(y[k, :lengths[k]].tolist()))
             print('---------------')
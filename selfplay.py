@@ -0,0 +1,160 @@
+"""
+Generate games by letting models play each other (or themselves), all games in lockstep.
+
+Every ply, the model of the side to move is forwarded once for all games (with a KV cache,
+feeding only the tokens played since its previous move), its next token is sampled among the
+legal ones (BatchC4Engine.legal_token_mask) with the side's temperature/top_k, and the move is
+played in BatchC4Engine, which also decides the results. The two sides may use different
+tokenizations, each model gets the game in its own vocabulary.
+
+The games are written as a dataset directory data/<out_dataset>/ in the layout prepare.py
+produces for the tokenization of data/<dataset>/: input.txt (one game per line), train.bin,
+val.bin (90/10 split, every game padded with its last token to block_size+1 tokens), the game
+lengths train_lengths.bin, val_lengths.bin and meta.pkl (copied).
+
+Example usage:
+$ python selfplay.py --model_a=out-connect-four-simple --num_games=10000 --out_dataset=connect_four_selfplay
+Greedy play (always the most likely legal move) with --temperature_a=0.0 (a float, like the default):
+$ python selfplay.py --model_a=out-connect-four-simple --temperature_a=0.0 --model_b=out-connect-four-player --out_dataset=connect_four_arena
+"""
+import os
+import pickle
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+from c4engine import C4Engine, BatchC4Engine
+from checkpoint import load_model
+from tokenizer import Tokenizer
+
+MAX_MOVES = C4Engine.WIDTH * C4Engine.HEIGHT
+
+
+class _Side:
+    ''' one model playing a side, with its own vocabulary and KV cache '''
+
+    def __init__(self, model, meta, temperature, top_k):
+        self.model = model
+        self.meta = meta
+        self.temperature = temperature
+        self.top_k = top_k
+        self.tokenizer = Tokenizer(meta)
+        self.cache = model.new_cache()
+        self.pending = [] # token ids (N,) not fed to the model yet
+
+
+@torch.no_grad()
+def self_play(models, metas, num_games: int, temperatures=(1.0, 1.0), top_ks=(None, None),
+              device: str = 'cpu', ctx=nullcontext()) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Play num_games games between models[0] (player A, moves first) and models[1] (player B).
+    A temperature of 0.0 plays the most likely legal move. Returns the columns of all moves
+    (N, MAX_MOVES) (padded with -1) and the result codes (N,).
+    '''
+    N = num_games
+    sides = [_Side(models[i], metas[i], temperatures[i], top_ks[i]) for i in range(2)]
+    if models[0] is models[1] and metas[0] is metas[1] and temperatures[0] == temperatures[1] and top_ks[0] == top_ks[1]:
+        sides[1] = sides[0] # self-play: one forward per ply
+    for s in sides:
+        s.pending = [np.full(N, s.meta['stoi'][s.meta['start_token']], dtype=np.int64)]
+
+    engine = BatchC4Engine(N)
+    moves = np.full((N, MAX_MOVES), -1, dtype=np.int8)
+    for ply in range(MAX_MOVES):
+        live = engine.results() == BatchC4Engine.NO_RESULT
+        if not live.any():
+            break
+        side = sides[ply % 2]
+        x = torch.from_numpy(np.stack(side.pending, axis=1)).to(device)
+        side.pending = []
+        with ctx:
+            logits, _ = side.model(x, cache=side.cache)
+        logits = logits[:, -1, :].float()
+
+        legal = torch.from_numpy(engine.legal_token_mask(side.meta)).to(device)
+        legal[~torch.from_numpy(live).to(device), :] = True # finished games: anything, ignored
+        if side.temperature == 0:
+            tokens = logits.masked_fill(~legal, -float('Inf')).argmax(dim=-1)
+        else:
+            logits = (logits / side.temperature).masked_fill(~legal, -float('Inf'))
+            if side.top_k is not None:
+                v, _ = torch.topk(logits, min(side.top_k, logits.size(-1)))
+                logits[logits < v[:, [-1]]] = -float('Inf')
+            tokens = torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1)[:, 0]
+        cols = np.where(live, side.tokenizer.token_cols[tokens.cpu().numpy()], -1)
+
+        played = engine.make_moves(cols)
+        moves[played, ply] = cols[played]
+
+        # feed the move to both sides, in their own vocabulary (finished games get their result token)
+        y, p = np.maximum(engine.last_y(), 0), ply % 2
+        for s in {id(s): s for s in sides}.values():
+            ids = np.where(played, s.tokenizer.move_ids[np.maximum(cols, 0), y, p], s.tokenizer.result_ids[engine.results()])
+            s.pending.append(np.maximum(ids, 0))
+
+    return moves, engine.results().copy()
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    model_a = 'out-connect-four-simple' # plays A (first move)
+    model_b = '' # plays B, defaults to model_a (self-play)
+    temperature_a = 1.0 # 0.0 - always the most likely legal move
+    temperature_b = 1.0
+    top_k_a = 0 # 0 - no top-k filtering
+    top_k_b = 0
+    num_games = 10000
+    batch_size = 2048 # games played at once
+    dataset = '' # tokenization of the output, defaults to the dataset of model_a
+    out_dataset = 'connect_four_selfplay'
+    seed = 1337
+    device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+    dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    torch.manual_seed(seed)
+    torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+    torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+    device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+    ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+    model_a, meta_a, config_a = load_model(model_a, device)
+    model_b, meta_b, _ = load_model(model_b, device) if model_b else (model_a, meta_a, None)
+    dataset = dataset or config_a['dataset']
+    with open(os.path.join('data', dataset, 'meta.pkl'), 'rb') as f:
+        meta = pickle.load(f)
+
+    t0 = time.time()
+    moves, results = [], []
+    for b in range(0, num_games, batch_size):
+        m, res = self_play((model_a, model_b), (meta_a, meta_b), min(batch_size, num_games - b),
+                              (temperature_a, temperature_b), (top_k_a or None, top_k_b or None), device, ctx)
+        moves.append(m)
+        results.append(res)
+    moves, results = np.concatenate(moves), np.concatenate(results)
+    dt = time.time() - t0
+    counts = np.bincount(results, minlength=len(BatchC4Engine.RESULT_CODES))
+    print(f"played {num_games:,} games in {dt:.2f}s ({num_games / dt:,.0f} games/s), "
+          + ', '.join(f"{c}: {counts[i]:,}" for i, c in enumerate(BatchC4Engine.RESULT_CODES) if i > 0))
+
+    # dataset in the layout of prepare.py
+    tokenizer = Tokenizer(meta)
+    ids = tokenizer.encode_columns(moves, results, meta['block_size'] + 1)
+    lengths = (moves >= 0).sum(axis=1) + 2 # start and result tokens
+    out_dir = os.path.join('data', out_dataset)
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, 'input.txt'), 'w') as f:
+        for game, n in zip(ids, lengths):
+            f.write(tokenizer.decode(game[:n]) + '\n')
+    split_n = int(num_games * 0.9)
+    ids[:split_n].astype(np.uint16).tofile(os.path.join(out_dir, 'train.bin'))
+    ids[split_n:].astype(np.uint16).tofile(os.path.join(out_dir, 'val.bin'))
+    lengths[:split_n].astype(np.uint8).tofile(os.path.join(out_dir, 'train_lengths.bin'))
+    lengths[split_n:].astype(np.uint8).tofile(os.path.join(out_dir, 'val_lengths.bin'))
+    with open(os.path.join(out_dir, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f)
+    print(f"wrote {out_dir}: train has {split_n:,} games, val has {num_games - split_n:,} games")
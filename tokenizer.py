@@ -0,0 +1,180 @@
+'''
+Tokenizations of Connect-Four games used by the datasets.
+
+Schemes (the vocabularies of data/connect_four_<scheme>/meta.pkl):
+- simple: one character per token, the column of a move (0-6), S (start) and A/B/D (result),
+  no separator, e.g. S3341D
+- player: column and player (a moves first), e.g. S 3a 3b 4a 1b D
+- full: column, row counted from the top and player, e.g. S 35a 34b 45a 15b D
+
+Tokenizer converts between token ids and column sequences with NumPy lookup tables, for whole
+(N, T) arrays of games at once: rows of the full scheme are computed with a cumulative count
+of the pieces in every column, results (if not given) by BatchC4Engine. TokenStream encodes
+a live game one move at a time. mirror_ids maps every token to its left/right mirror image
+(column c -> WIDTH-1-c, row and player kept), the board is symmetric so a mirrored game is
+another valid game with the same result.
+'''
+import numpy as np
+
+from c4engine import C4Engine, BatchC4Engine
+
+SCHEMES = ('simple', 'player', 'full')
+COLUMNS = ''.join(str(x) for x in range(C4Engine.WIDTH))
+ROWS = ''.join(str(y) for y in range(C4Engine.HEIGHT))
+PLAYERS = C4Engine.PLAYERS.lower() # a moves first
+
+
+def vocab(scheme: str) -> list[str]:
+    ''' tokens of a scheme, in the order of their ids '''
+    if scheme == 'simple':
+        return list(COLUMNS + C4Engine.RESULT_TYPES + C4Engine.START)
+    special = [C4Engine.START] + list(C4Engine.RESULT_TYPES)
+    if scheme == 'player':
+        return special + [x + p for x in COLUMNS for p in PLAYERS]
+    if scheme == 'full':
+        return special + [x + y + p for x in COLUMNS for y in ROWS for p in PLAYERS]
+    raise ValueError(f'unknown scheme {scheme}, expected one of {SCHEMES}')
+
+
+def build_meta(scheme: str, block_size: int) -> dict:
+    ''' meta.pkl contents of a dataset of the scheme '''
+    tokens = vocab(scheme)
+    stoi = {t: i for i, t in enumerate(tokens)}
+    return {
+        'vocab_size': len(tokens),
+        'itos': {i: t for i, t in enumerate(tokens)},
+        'stoi': stoi,
+        'stom': {t: t[0] for t in tokens},
+        'separator': '' if scheme == 'simple' else ' ',
+        'block_size': block_size,
+        'eos_token_ids': [stoi[r] for r in C4Engine.RESULT_TYPES],
+        'start_token': C4Engine.START,
+    }
+
+
+def scheme_of(meta: dict) -> str:
+    ''' scheme of a meta.pkl vocabulary, from the length of its move tokens '''
+    return SCHEMES[max(len(t) for t in meta['stoi']) - 1]
+
+
+class Tokenizer:
+
+    def __init__(self, meta: dict):
+        self.meta = meta
+        self.scheme = scheme_of(meta)
+        self.separator = meta['separator']
+        self.stoi, self.itos = meta['stoi'], meta['itos']
+        self.vocab_size = meta['vocab_size']
+        self.start_id = self.stoi[meta['start_token']]
+
+        # move_ids[column, row from the top, player], result_ids[BatchC4Engine result code]
+        self.move_ids = np.full((C4Engine.WIDTH, C4Engine.HEIGHT, 2), -1, dtype=np.int64)
+        self.result_ids = np.full(len(BatchC4Engine.RESULT_CODES), -1, dtype=np.int64)
+        # column and result code of every token (-1 if the token is not a move / result)
+        self.token_cols = np.full(self.vocab_size, -1, dtype=np.int64)
+        self.token_results = np.full(self.vocab_size, -1, dtype=np.int64)
+        for i, token in self.itos.items():
+            move = meta['stom'][token]
+            if move in C4Engine.RESULT_TYPES:
+                self.result_ids[BatchC4Engine.RESULT_CODES.index(move)] = i
+                self.token_results[i] = BatchC4Engine.RESULT_CODES.index(move)
+            elif move != C4Engine.START:
+                x = self.token_cols[i] = int(move)
+                rows = [int(token[1])] if len(token) > 2 else range(C4Engine.HEIGHT)
+                players = [PLAYERS.index(token[-1])] if len(token) > 1 else [0, 1]
+                for y in rows:
+                    for p in players:
+                        self.move_ids[x, y, p] = i
+        # mirror_ids[token id]: id of the token with the column mirrored, a permutation of the vocabulary
+        self.mirror_ids = np.arange(self.vocab_size, dtype=np.int64)
+        for i, token in self.itos.items():
+            if self.token_cols[i] >= 0:
+                self.mirror_ids[i] = self.stoi[str(C4Engine.WIDTH - 1 - self.token_cols[i]) + token[1:]]
+
+
+    def encode(self, s: str) -> list[int]:
+        return [self.stoi[t] for t in (list(s) if self.separator == '' else s.split(self.separator))]
+
+
+    def decode(self, ids) -> str:
+        return self.separator.join(self.itos[int(i)] for i in ids)
+
+
+    def move_tokens(self, cols: np.ndarray) -> np.ndarray:
+        ''' (N, T) token ids of the moves of games given as (N, T) columns (padded with -1 after the last move, -1 there) '''
+        cols = np.asarray(cols, dtype=np.int64)
+        played = cols >= 0
+        safe_cols = np.where(played, cols, 0)
+        # pieces already in the column of every move
+        onehot = (cols[..., None] == np.arange(C4Engine.WIDTH)).astype(np.int64)
+        below = np.take_along_axis(np.cumsum(onehot, axis=-2) - onehot, safe_cols[..., None], axis=-1)[..., 0]
+        rows = np.clip(C4Engine.HEIGHT - 1 - below, 0, C4Engine.HEIGHT - 1)
+        players = np.arange(cols.shape[-1]) % 2
+        return np.where(played, self.move_ids[safe_cols, rows, players], -1)
+
+
+    def encode_columns(self, cols: np.ndarray, results: np.ndarray | None = None, length: int | None = None) -> np.ndarray:
+        '''
+        (N, length) token ids of games given as (N, T) columns (padded with -1): start token, moves,
+        result token, padded with the last token (the train.bin layout with length=block_size+1).
+        results are BatchC4Engine result codes (N,), computed by replaying the games if not given.
+        '''
+        cols = np.asarray(cols, dtype=np.int64)
+        N, T = cols.shape
+        if results is None:
+            engine = BatchC4Engine(N)
+            engine.play(cols)
+            results = engine.results()
+        length = length or T + 2
+        L = min(T, length - 1)
+        tokens = self.move_tokens(cols[:, :L])
+        ids = np.empty((N, length), dtype=np.int64)
+        ids[:, 0] = self.start_id
+        ids[:, 1:] = np.maximum(self.result_ids[results], 0)[:, None]
+        ids[:, 1:L+1] = np.where(tokens >= 0, tokens, ids[:, 1:L+1])
+        # games without a result are padded with their last move (or the start token)
+        unfinished = results == BatchC4Engine.NO_RESULT
+        if unfinished.any():
+            last = np.minimum((tokens >= 0).sum(axis=1), length - 1)
+            after = unfinished[:, None] & (np.arange(length) > last[:, None])
+            ids = np.where(after, ids[np.arange(N), last][:, None], ids)
+        return ids
+
+
+    def decode_columns(self, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        ''' columns (N, T) (-1 for non-move tokens) and result codes (N,) (of the first result token) of (N, T) token ids '''
+        ids = np.asarray(ids, dtype=np.int64)
+        results = self.token_results[ids]
+        has_result = (results >= 0).any(axis=1)
+        first = np.where(has_result, (results >= 0).argmax(axis=1), 0)
+        return self.token_cols[ids], np.where(has_result, results[np.arange(len(ids)), first], BatchC4Engine.NO_RESULT)
+
+
+    def encode_moves(self, moves: str) -> list[int]:
+        ''' token ids of a game in the simple notation of C4Engine (e.g. S3341, optionally ending with the result) '''
+        assert moves.startswith(C4Engine.START)
+        body = moves[1:]
+        result = body[-1] if body and body[-1] in C4Engine.RESULT_TYPES else None
+        cols = np.array([[int(m) for m in (body[:-1] if result else body)]], dtype=np.int64).reshape(1, -1)
+        ids = [self.start_id] + self.move_tokens(cols)[0].tolist()
+        if result:
+            ids.append(int(self.result_ids[BatchC4Engine.RESULT_CODES.index(result)]))
+        return ids
+
+
+class TokenStream:
+    ''' token ids of a game being played, extended one move at a time '''
+
+    def __init__(self, tokenizer: Tokenizer):
+        self.tokenizer = tokenizer
+        self.heights = [0] * C4Engine.WIDTH
+        self.ids = [tokenizer.start_id]
+
+
+    def push(self, col: int) -> int:
+        ''' append the token of a move in column col, return its id '''
+        row = C4Engine.HEIGHT - 1 - self.heights[col]
+        token = int(self.tokenizer.move_ids[col, row, (len(self.ids) - 1) % 2])
+        self.heights[col] += 1
+        self.ids.append(token)
+        return token
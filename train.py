@@ -22,12 +22,14 @@ import math
 import pickle
 from contextlib import nullcontext
 
-import numpy as np
 import torch
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.distributed import init_process_group, destroy_process_group
 
 from model import GPTConfig, GPT
+from checkpoint import export_checkpoint, MODEL_FILE
+from data_loader import BatchLoader
+from tokenizer import Tokenizer
 
 # -----------------------------------------------------------------------------
 # default config values designed to train a gpt2 (124M) on OpenWebText
@@ -49,6 +51,11 @@ dataset = 'openwebtext'
 gradient_accumulation_steps = 5 * 8 # used to simulate larger batch sizes
 batch_size = 12 # if gradient_accumulation_steps > 1, this is the micro-batch size
 block_size = 1024
+data_prefetch = 2 # batches prepared ahead by a background thread (0 - prepare in the training loop)
+data_sampling = 'random' # 'random' - games sampled with replacement, 'epoch' - every game once per epoch, shuffled and sharded across ddp ranks
+data_layout = 'padded' # 'padded', 'masked' (no loss on the padding after the result) or 'bucketed' (masked, batches of similar length, cut to it)
+data_mirror = 0.0 # probability of mirroring a training game left/right (column c -> 6-c), 0.5 doubles the data
+eval_mirror = False # if True, also estimate the loss on the mirrored val games (val_mirror)
 # model
 n_layer = 12
 n_head = 12
@@ -98,6 +105,7 @@ else:
     # if not ddp, we are running on a single gpu, and one process
     master_process = True
     seed_offset = 0
+    ddp_rank = 0
     ddp_world_size = 1
 tokens_per_iter = gradient_accumulation_steps * ddp_world_size * batch_size * block_size
 print(f"tokens per iteration will be: {tokens_per_iter:,}")
@@ -112,33 +120,11 @@ device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.aut
 ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
-# poor man's data loader
 data_dir = os.path.join('data', dataset)
-def get_batch(split):
-    # We recreate np.memmap every batch to avoid a memory leak, as per
-    # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
-    if split == 'train':
-        data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    else:
-        data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-    data = data.reshape(-1, block_size+1)
-    # TODO: don't select random blocks - just iterate over all of them ???
-    ix = torch.randint(len(data), (batch_size,))
-    x = torch.stack([torch.from_numpy((data[i,:-1]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i,1:]).astype(np.int64)) for i in ix])
-    if device_type == 'cuda':
-        # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-    else:
-        x, y = x.to(device), y.to(device)
-    return x, y
-
-# init these up here, can override if init_from='resume' (i.e. from a checkpoint)
-iter_num = 0
-best_val_loss = 1e9
 
 # attempt to derive vocab_size from the dataset
 meta_path = os.path.join(data_dir, 'meta.pkl')
+meta = None
 meta_vocab_size = None
 meta_eos_token_ids = []
 if os.path.exists(meta_path):
@@ -149,6 +135,31 @@ if os.path.exists(meta_path):
     print(f"found vocab_size = {meta_vocab_size} (inside {meta_path})")
     print(f"found eos_token_ids = {meta_eos_token_ids} (inside {meta_path})")
 
+# left/right mirror augmentation: a permutation of the token ids, applied on the device
+mirror_table = None
+if data_mirror > 0 or eval_mirror:
+    assert meta is not None, 'mirroring needs the vocabulary of meta.pkl'
+    mirror_table = torch.from_numpy(Tokenizer(meta).mirror_ids)
+# data loader: splits are read once, batches are gathered and prefetched in the background (see data_loader.py)
+loaders = {split: BatchLoader(os.path.join(data_dir, f'{split}.bin'), block_size, batch_size, device, data_prefetch,
+                              'random', 1337 + 1000 * (split == 'val'), ddp_rank, ddp_world_size, data_layout,
+                              mirror_table=mirror_table, mirror=data_mirror if split == 'train' else 0.0)
+           for split in ['train', 'val']}
+if eval_mirror: # the same games as the val batches (same seed), all mirrored
+    loaders['val_mirror'] = BatchLoader(os.path.join(data_dir, 'val.bin'), block_size, batch_size, device, data_prefetch,
+                                        'random', 1337 + 1000, ddp_rank, ddp_world_size, data_layout,
+                                        mirror_table=mirror_table, mirror=1.0)
+# losses are always estimated on random batches, epoch mode gets its own training loader
+train_loader = loaders['train'] if data_sampling == 'random' else \
+    BatchLoader(os.path.join(data_dir, 'train.bin'), block_size, batch_size, device, data_prefetch,
+                'epoch', 1337, ddp_rank, ddp_world_size, data_layout, mirror_table=mirror_table, mirror=data_mirror)
+def get_batch(split):
+    return loaders[split].next()
+
+# init these up here, can override if init_from='resume' (i.e. from a checkpoint)
+iter_num = 0
+best_val_loss = 1e9
+
 # model init
 model_args = dict(n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size,
                   bias=bias, vocab_size=None, dropout=dropout, eos_token_ids=meta_eos_token_ids) # start with model_args from command line
@@ -184,6 +195,8 @@ elif init_from == 'resume':
     model.load_state_dict(state_dict)
     iter_num = checkpoint['iter_num']
     best_val_loss = checkpoint['best_val_loss']
+    if data_sampling == 'epoch' and checkpoint.get('data_state'):
+        train_loader.load_state_dict(checkpoint['data_state'])
 elif init_from.startswith('gpt2'):
     print(f"Initializing from OpenAI GPT-2 weights: {init_from}")
     # initialize from OpenAI GPT-2 weights
@@ -222,7 +235,7 @@ if ddp:
 def estimate_loss():
     out = {}
     model.eval()
-    for split in ['train', 'val']:
+    for split in loaders:
         losses = torch.zeros(eval_iters)
         for k in range(eval_iters):
             X, Y = get_batch(split)
@@ -253,11 +266,15 @@ if wandb_log and master_process:
     wandb.init(project=wandb_project, name=wandb_run_name, config=config)
 
 # training loop
-X, Y = get_batch('train') # fetch the very first batch
+data_state = train_loader.state_dict() # sampler position of the batch X, saved with the checkpoints
+X, Y = train_loader.next() # fetch the very first batch
+batch_tokens = train_loader.tokens # game tokens (without the padding) of X, Y
 t0 = time.time()
 local_iter_num = 0 # number of iterations in the lifetime of this process
 raw_model = model.module if ddp else model # unwrap DDP container if needed
 running_mfu = -1.0
+data_time = 0.0 # time spent waiting for training batches in this iteration
+data_tokens = 0 # game tokens trained on in this iteration, tok/s is comparable across data layouts
 while True:
 
     # determine and set the learning rate for this iteration
@@ -268,14 +285,17 @@ while True:
     # evaluate the loss on train/val sets and write checkpoints
     if iter_num % eval_interval == 0 and master_process:
         losses = estimate_loss()
-        print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
+        val_mirror = f", val_mirror loss {losses['val_mirror']:.4f}" if eval_mirror else ''
+        print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}{val_mirror}")
         if wandb_log:
             wandb.log({
                 "iter": iter_num,
                 "train/loss": losses['train'],
                 "val/loss": losses['val'],
+                **({"val_mirror/loss": losses['val_mirror']} if eval_mirror else {}),
                 "lr": lr,
                 "mfu": running_mfu*100, # convert to percentage
+                **({"epoch": train_loader.progress(data_state)} if data_sampling == 'epoch' else {}),
             })
         if losses['val'] < best_val_loss or always_save_checkpoint:
             best_val_loss = losses['val']
@@ -287,9 +307,11 @@ while True:
                     'iter_num': iter_num,
                     'best_val_loss': best_val_loss,
                     'config': config,
+                    'data_state': data_state,
                 }
                 print(f"saving checkpoint to {out_dir}")
                 torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
+                export_checkpoint(checkpoint, os.path.join(out_dir, MODEL_FILE), meta) # weights only, for inference
     if iter_num == 0 and eval_only:
         break
 
@@ -306,7 +328,12 @@ while True:
             logits, loss = model(X, Y)
             loss = loss / gradient_accumulation_steps # scale the loss to account for gradient accumulation
         # immediately async prefetch next batch while model is doing the forward pass on the GPU
-        X, Y = get_batch('train')
+        data_tokens += batch_tokens
+        t = time.time()
+        data_state = train_loader.state_dict()
+        X, Y = train_loader.next()
+        data_time += time.time() - t
+        batch_tokens = train_loader.tokens
         # backward pass, with gradient scaling if training in fp16
         scaler.scale(loss).backward()
     # clip the gradient
@@ -330,7 +357,11 @@ while True:
         if local_iter_num >= 5: # let the training loop settle a bit
             mfu = raw_model.estimate_mfu(batch_size * gradient_accumulation_steps, dt)
             running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
-        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%")
+        epoch = f", epoch {train_loader.progress(data_state):.4f}" if data_sampling == 'epoch' else ''
+        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, data {data_time*1000:.2f}ms, "
+              f"tok/s {data_tokens / dt:,.0f}, mfu {running_mfu*100:.2f}%{epoch}")
+    data_time = 0.0
+    data_tokens = 0
     iter_num += 1
     local_iter_num += 1
 